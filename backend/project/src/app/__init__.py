@@ -1,13 +1,17 @@
+import os
+import click
 from flask import Flask, redirect, url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_smorest import Api
 from dotenv import load_dotenv
+from src.app.utils.json_provider import ORJSONProvider
 
 db = SQLAlchemy()
 
 def create_app():
     load_dotenv() # Load environment variables from .env file
     app = Flask(__name__, instance_relative_config=True)
+    app.json = ORJSONProvider(app)
     
     app.config.from_object('src.app.config.config.Config')
     app.config["API_TITLE"] = "Invoice Risk Assessment API"
@@ -28,11 +32,40 @@ def create_app():
     api.register_blueprint(DashboardBlueprint)
     api.register_blueprint(VendorBlueprint)
 
-    # Create database tables within the app context
-    # This ensures models are registered correctly before creation
-    with app.app_context():
+    # Tables are created once at deploy time with `flask init-db`, not on every app/worker start
+    @app.cli.command("init-db")
+    def init_db():
+        """Create the database tables."""
+        # Import models so they are registered on the metadata before creation
         from src.app import models
         db.create_all()
+        click.echo("Database tables created.")
+
+    @app.cli.command("backfill-narratives")
+    @click.option("--risk-level", type=click.Choice(["Low", "Medium", "High"]), default=None, help="Only include invoices at this risk level.")
+    @click.option("--output", default="narratives.json", show_default=True, help="File to write {invoice_id: narrative} to.")
+    def backfill_narratives(risk_level, output):
+        """Generate narratives for stored invoices through the Azure OpenAI Batch API."""
+        from src.app.services.database_ops import get_all_invoices
+        from src.app.services.narrative_service import generate_narratives_via_batch_api
+        import orjson
+
+        # Credentials come from the environment since there is no user in the loop
+        api_key = os.environ.get("AZURE_OPENAI_API_KEY")
+        api_endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
+        deployment_name = os.environ.get("AZURE_OPENAI_BATCH_DEPLOYMENT")
+        if not all([api_key, api_endpoint, deployment_name]):
+            raise click.ClickException("Set AZURE_OPENAI_API_KEY, AZURE_OPENAI_ENDPOINT and AZURE_OPENAI_BATCH_DEPLOYMENT.")
+
+        invoices = get_all_invoices(risk_level=risk_level)
+        try:
+            narratives = generate_narratives_via_batch_api(invoices, api_key, api_endpoint, deployment_name)
+        except Exception as e:
+            # Exits non-zero so schedulers see a failed or expired batch job
+            raise click.ClickException(str(e)) from e
+        with open(output, "wb") as f:
+            f.write(orjson.dumps(narratives, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2))
+        click.echo(f"Wrote {len(narratives)} narratives to {output}.")
 
     @app.route('/')
     def index():
@@ -1,22 +1,190 @@
 import re
+import io
+import asyncio
+import os
+import hashlib
+import threading
+import orjson
 import pdfplumber
-from datetime import datetime
+import pypdfium2 as pdfium
+from datetime import datetime, date, timezone
 from src.app.utils.exceptions import InvoiceValidationError
-from openai import AzureOpenAI
+from src.app.utils.openai_client import get_azure_openai_client, DEFAULT_API_VERSION
+from openai import AsyncAzureOpenAI
 import json
 from flask import current_app
 
-def ingest_invoice_pdf(file_stream, api_key: str, api_endpoint: str, deployment_name: str, model_name: str) -> dict:
+# Bump whenever the extraction prompt or normalization changes so stale cache entries are ignored.
+PROMPT_VERSION = "2"
+REQUIRED_FIELDS = ['invoice_id', 'vendor_name', 'invoice_date', 'total_amount']
+# One initial call plus one retry that feeds the validation error back to the model.
+EXTRACTION_ATTEMPTS = 2
+EXTRACT_CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'processed', '.extract_cache'))
+
+# Each pattern selects the strptime format(s) to try, so a date is parsed with a single
+# regex match instead of trial-and-error over every format. DD-MM-YYYY and MM-DD-YYYY
+# share a shape and are tried in that order.
+_DATE_FORMATS = [
+    (re.compile(r'\d{4}-\d{1,2}-\d{1,2}'), ('%Y-%m-%d',)),
+    (re.compile(r'\d{1,2}-\d{1,2}-\d{4}'), ('%d-%m-%Y', '%m-%d-%Y')),
+    (re.compile(r'[A-Za-z]{3} \d{1,2}, \d{4}'), ('%b %d, %Y',)),
+]
+
+def _parse_invoice_date(value):
+    """Parses a date string in one of the supported formats, returning None if it matches none."""
+    if not isinstance(value, str):
+        return None
+    for pattern, date_formats in _DATE_FORMATS:
+        if pattern.fullmatch(value):
+            for date_format in date_formats:
+                try:
+                    return datetime.strptime(value, date_format).date()
+                except ValueError:
+                    continue
+            return None
+    return None
+
+# Below this many characters the embedded text layer is treated as missing (scanned or unusual layouts).
+MIN_TEXT_LAYER_CHARS = 20
+
+# PDFium is not thread-safe, even across separate documents, and batch uploads extract
+# from several threads at once. Extraction takes ~1 ms per invoice, so a lock costs little.
+_PDFIUM_LOCK = threading.Lock()
+
+def _extract_text_layer(file_stream) -> str:
+    """Reads the embedded text layer with PDFium (C++), avoiding pdfminer's pure-Python parser."""
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(file_stream.getvalue())
+        try:
+            page_texts = []
+            for page_index in range(len(pdf)):
+                page = pdf[page_index]
+                textpage = page.get_textpage()
+                page_texts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+    return "\n".join(page_texts).replace('\r\n', '\n')
+
+def _extract_text_with_pdfplumber(file_stream) -> str:
     """
-    Ingests an invoice PDF from a file stream, extracts text, and uses user-provided
-    Azure OpenAI credentials to extract key information in a structured format.
+    Extracts text with pdfplumber. It opens documents with laparams=None, so pdfminer's layout
+    analysis never runs; pdfplumber groups characters into lines itself, which keeps invoice
+    table rows on one line for the LLM.
+    """
+    # Pages are parsed serially: pdfminer is pure Python, so threads gain nothing, and a process
+    # pool per call would fork from request and monitor worker threads for a rarely used path.
+    with pdfplumber.open(file_stream) as pdf:
+        return "".join(page.extract_text() or "" for page in pdf.pages)
+
+def _validate_extracted_data(response_content: str) -> dict:
+    """Parses the model's JSON-mode reply and validates/normalizes the required fields."""
+    try:
+        extracted_data = orjson.loads(response_content or "")
+    except orjson.JSONDecodeError as e:
+        raise InvoiceValidationError(f"AI model returned invalid JSON: {e}")
+
+    if not isinstance(extracted_data, dict):
+        raise InvoiceValidationError("AI model did not return a JSON object.")
+
+    if not all(key in extracted_data for key in REQUIRED_FIELDS):
+        missing_fields = [key for key in REQUIRED_FIELDS if key not in extracted_data]
+        raise InvoiceValidationError(f"AI model did not return all required fields. Missing: {', '.join(missing_fields)}")
+
+    try:
+        validated_amount = float(extracted_data['total_amount'])
+    except (ValueError, TypeError):
+        raise InvoiceValidationError(f"Invalid amount format returned by AI: {extracted_data['total_amount']}")
+
+    validated_date = _parse_invoice_date(extracted_data.get('invoice_date'))
+    if not validated_date:
+        raise InvoiceValidationError(f"Invalid date format returned by AI: {extracted_data['invoice_date']}. Could not parse.")
+
+    return {
+        "invoice_id": extracted_data['invoice_id'],
+        "vendor_name": extracted_data['vendor_name'],
+        "invoice_date": validated_date,
+        "total_amount": validated_amount
+    }
+
+def _hash_pdf_bytes(pdf_bytes: bytes) -> str:
+    """Returns the SHA-256 of the PDF bytes, length-prefixed to avoid collisions."""
+    digest = hashlib.sha256(len(pdf_bytes).to_bytes(8, 'big'))
+    digest.update(pdf_bytes)
+    return digest.hexdigest()
+
+def _extraction_cache_path(model_name: str, pdf_sha: str) -> str:
+    key = hashlib.sha256(json.dumps([model_name, PROMPT_VERSION, pdf_sha]).encode('utf-8')).hexdigest()
+    return os.path.join(EXTRACT_CACHE_DIR, f"{key}.json")
+
+def _load_cached_extraction(cache_path: str):
+    """Returns the cached extraction result, or None on a miss or a malformed entry."""
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached_data = json.load(f).get('data') or {}
+    except (OSError, ValueError, AttributeError):
+        return None
+
+    if not all(key in cached_data for key in REQUIRED_FIELDS):
+        return None
+
+    try:
+        return {
+            "invoice_id": cached_data['invoice_id'],
+            "vendor_name": cached_data['vendor_name'],
+            "invoice_date": date.fromisoformat(cached_data['invoice_date']),
+            "total_amount": float(cached_data['total_amount'])
+        }
+    except (ValueError, TypeError):
+        return None
+
+def _store_cached_extraction(cache_path: str, result: dict):
+    """Writes the validated extraction result to the cache. Failures are logged, never raised."""
+    entry = {
+        "cached_at": datetime.now(timezone.utc).isoformat(),
+        "data": {**result, "invoice_date": result['invoice_date'].isoformat()}
+    }
+    try:
+        os.makedirs(EXTRACT_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        current_app.logger.warning(f"Could not write extraction cache entry {cache_path}: {e}")
+
+def _prepare_extraction(file_stream, model_name: str):
     """
-    # 1. Extract Raw Text using pdfplumber
+    Hashes the PDF and checks the extraction cache. On a miss, extracts the raw text and
+    builds the LLM messages. Returns (cache_path, cached_result, messages).
+    """
+    # 0. Return the cached extraction if this exact PDF was already processed.
+    # Everything below reads one in-memory buffer; getvalue() on an unmodified BytesIO does not copy.
+    try:
+        if not isinstance(file_stream, io.BytesIO):
+            file_stream = io.BytesIO(file_stream.read())
+        cache_path = _extraction_cache_path(model_name, _hash_pdf_bytes(file_stream.getvalue()))
+    except Exception as e:
+        current_app.logger.error(f"Failed to read PDF stream: {e}")
+        raise InvoiceValidationError(f"Could not process PDF file stream: {e}")
+
+    cached_result = _load_cached_extraction(cache_path)
+    if cached_result is not None:
+        current_app.logger.info(f"Extraction cache hit: {os.path.basename(cache_path)}")
+        return cache_path, cached_result, None
+
+    # 1. Extract Raw Text, preferring the embedded text layer and falling back to pdfplumber
     try:
-        with pdfplumber.open(file_stream) as pdf:
-            raw_text = ""
-            for page in pdf.pages:
-                raw_text += page.extract_text() or ""
+        raw_text = ""
+        try:
+            raw_text = _extract_text_layer(file_stream)
+        except Exception as e:
+            current_app.logger.warning(f"Text layer extraction failed, falling back to pdfplumber: {e}")
+
+        if len(raw_text.strip()) < MIN_TEXT_LAYER_CHARS:
+            file_stream.seek(0)
+            raw_text = _extract_text_with_pdfplumber(file_stream)
         
         if not raw_text.strip():
             raise InvoiceValidationError("PDF is empty or contains no extractable text.")
@@ -33,7 +201,7 @@ def ingest_invoice_pdf(file_stream, api_key: str, api_endpoint: str, deployment_
     1.  The 'invoice_date' must be in YYYY-MM-DD format.
     2.  The 'total_amount' must be a single number with a decimal point (e.g., 1234.56). Do not include currency symbols, commas, or any other text.
     3.  The 'vendor_name' should be the name of the company sending the invoice.
-    4.  Your entire response must be ONLY the JSON object, with no other text, explanations, or markdown formatting.
+    4.  Respond with a single JSON object containing exactly these four keys.
 
     --- RAW INVOICE TEXT ---
     {raw_text}
@@ -42,58 +210,92 @@ def ingest_invoice_pdf(file_stream, api_key: str, api_endpoint: str, deployment_
     Now, provide the JSON object.
     """
 
-    # 3. Call the LLM to perform the extraction
+    return cache_path, None, [{"role": "user", "content": prompt}]
+
+def _check_extraction_reply(messages: list, response_content: str, attempt: int):
+    """
+    Validates a model reply. Returns the result, or None after appending retry feedback to
+    messages. Raises InvoiceValidationError once the attempts are used up.
+    """
+    # 4. Validate and normalize the extracted data
     try:
-        client = AzureOpenAI(
-            api_version="2024-02-01",
-            azure_endpoint=api_endpoint,
-            api_key=api_key,
-        )
-        messages = [{"role": "user", "content": prompt}]
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            temperature=0.0
-        )
-        
-        response_content = response.choices[0].message.content
-        
-        # Clean the response to ensure it's valid JSON
-        cleaned_response = response_content.strip().replace('```json', '').replace('```', '').strip()
-        
-        extracted_data = json.loads(cleaned_response)
+        return _validate_extracted_data(response_content)
+    except InvoiceValidationError as e:
+        if attempt == EXTRACTION_ATTEMPTS:
+            raise
+        current_app.logger.warning(f"Extraction attempt {attempt} returned invalid data, retrying: {e.message}")
+        messages += [
+            {"role": "assistant", "content": response_content or ""},
+            {"role": "user", "content": f"Your previous response was invalid: {e.message} Return the corrected JSON object only."}
+        ]
+        return None
 
-    except Exception as e:
-        current_app.logger.error(f"LLM extraction failed. Error: {e}")
-        raise InvoiceValidationError(f"AI model failed to extract data from the invoice. Error: {e}")
+def ingest_invoice_pdf(file_stream, api_key: str, api_endpoint: str, deployment_name: str, model_name: str) -> dict:
+    """
+    Ingests an invoice PDF from a file stream, extracts text, and uses user-provided
+    Azure OpenAI credentials to extract key information in a structured format.
+    Results are cached on disk by (model, prompt version, PDF hash), so re-uploading
+    the same PDF skips the LLM call.
+    """
+    cache_path, cached_result, messages = _prepare_extraction(file_stream, model_name)
+    if cached_result is not None:
+        return cached_result
 
-    # 4. Validate and normalize the extracted data
-    required_fields = ['invoice_id', 'vendor_name', 'invoice_date', 'total_amount']
-    if not all(key in extracted_data for key in required_fields):
-        missing_fields = [key for key in required_fields if key not in extracted_data]
-        raise InvoiceValidationError(f"AI model did not return all required fields. Missing: {', '.join(missing_fields)}")
+    # 3. Call the LLM in JSON mode; on invalid output, retry once with the validation error as feedback
+    client = get_azure_openai_client(api_endpoint, api_key)
+    for attempt in range(1, EXTRACTION_ATTEMPTS + 1):
+        try:
+            response = client.chat.completions.create(
+                model=model_name,
+                messages=messages,
+                temperature=0.0,
+                response_format={"type": "json_object"}
+            )
+            response_content = response.choices[0].message.content
+        except Exception as e:
+            current_app.logger.error(f"LLM extraction failed. Error: {e}")
+            raise InvoiceValidationError(f"AI model failed to extract data from the invoice. Error: {e}")
 
-    try:
-        validated_amount = float(extracted_data['total_amount'])
-    except (ValueError, TypeError):
-        raise InvoiceValidationError(f"Invalid amount format returned by AI: {extracted_data['total_amount']}")
+        result = _check_extraction_reply(messages, response_content, attempt)
+        if result is not None:
+            break
+
+    _store_cached_extraction(cache_path, result)
+    return result
 
-    # Try parsing multiple common date formats
-    validated_date = None
-    possible_formats = ['%Y-%m-%d', '%d-%m-%Y', '%m-%d-%Y', '%b %d, %Y']
-    for date_format in possible_formats:
+async def _ingest_invoice_pdf_async(client: AsyncAzureOpenAI, file_stream, model_name: str) -> dict:
+    # Text extraction is CPU-bound; run it off the event loop so LLM calls keep overlapping
+    cache_path, cached_result, messages = await asyncio.to_thread(_prepare_extraction, file_stream, model_name)
+    if cached_result is not None:
+        return cached_result
+
+    for attempt in range(1, EXTRACTION_ATTEMPTS + 1):
         try:
-            validated_date = datetime.strptime(extracted_data.get('invoice_date'), date_format).date()
-            break  # Stop on the first successful parse
-        except (ValueError, TypeError):
-            continue
-    
-    if not validated_date:
-        raise InvoiceValidationError(f"Invalid date format returned by AI: {extracted_data['invoice_date']}. Could not parse.")
+            response = await client.chat.completions.create(
+                model=model_name,
+                messages=messages,
+                temperature=0.0,
+                response_format={"type": "json_object"}
+            )
+            response_content = response.choices[0].message.content
+        except Exception as e:
+            current_app.logger.error(f"LLM extraction failed. Error: {e}")
+            raise InvoiceValidationError(f"AI model failed to extract data from the invoice. Error: {e}")
 
-    return {
-        "invoice_id": extracted_data['invoice_id'],
-        "vendor_name": extracted_data['vendor_name'],
-        "invoice_date": validated_date,
-        "total_amount": validated_amount
-    }
\ No newline at end of file
+        result = _check_extraction_reply(messages, response_content, attempt)
+        if result is not None:
+            break
+
+    _store_cached_extraction(cache_path, result)
+    return result
+
+async def ingest_invoice_pdfs_async(file_streams: list, api_key: str, api_endpoint: str, deployment_name: str, model_name: str) -> list:
+    """
+    Ingests several invoice PDFs concurrently. All LLM calls share one async client (and its
+    connection pool) and overlap on the network. Results are returned in input order.
+    """
+    # Async clients are bound to the running event loop, so one is created per batch instead of cached
+    async with AsyncAzureOpenAI(api_version=DEFAULT_API_VERSION, azure_endpoint=api_endpoint, api_key=api_key) as client:
+        return await asyncio.gather(*[
+            _ingest_invoice_pdf_async(client, file_stream, model_name) for file_stream in file_streams
+        ])
@@ -12,6 +12,10 @@ class Invoice(db.Model):
     risk_level = db.Column(db.String(50), nullable=True)
     original_filename = db.Column(db.String(255), nullable=True) # New field
     risk_factors = db.relationship('RiskFactor', backref='invoice', cascade='all, delete-orphan', lazy=True)
+    __table_args__ = (
+        db.Index('ix_invoice_risk_level_date', 'risk_level', 'invoice_date'), # Listing filter + date sort
+        db.Index('ix_invoice_vendor', 'vendor_name'), # Vendor statistics
+    )
 
     def __repr__(self):
         return f'<Invoice {self.id}>'
@@ -1,7 +1,8 @@
+from flask import jsonify
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort
-from ..services.database_ops import get_summary_statistics
-from ..schemas.invoice_schema import DashboardSummarySchema
+from ..services.database_ops import get_all_invoices, get_summary_statistics
+from ..schemas.invoice_schema import DashboardBootstrapSchema, DashboardSummarySchema, InvoiceQueryArgsSchema, serialize_invoice
 
 blp = Blueprint(
     "Dashboard", "dashboard", url_prefix="/api/dashboard", description="Dashboard summary metrics"
@@ -9,7 +10,8 @@ blp = Blueprint(
 
 @blp.route("/summary")
 class DashboardSummary(MethodView):
-    @blp.doc(summary="Get Dashboard Summary", description="Retrieves key summary metrics for the dashboard, including total invoices, counts by risk level, and average risk score.")
+    @blp.etag
+    @blp.doc(summary="Get Dashboard Summary", description="Retrieves key summary metrics for the dashboard, including total invoices, counts by risk level, and average risk score. Send the returned ETag in If-None-Match to get a 304 when the metrics are unchanged.")
     @blp.response(200, DashboardSummarySchema)
     def get(self):
         """Get dashboard summary statistics"""
@@ -18,3 +20,30 @@ class DashboardSummary(MethodView):
             return summary
         except Exception as e:
             abort(500, message=str(e))
+
+@blp.route("/bootstrap")
+class DashboardBootstrap(MethodView):
+    @blp.etag
+    @blp.doc(summary="Get Dashboard Bootstrap", description="Returns the summary metrics, vendor list, and invoice listing in one response, so the dashboard loads with a single request. Accepts the same filters as the invoice listing and supports If-None-Match.")
+    @blp.arguments(InvoiceQueryArgsSchema, location="query")
+    @blp.response(200, DashboardBootstrapSchema)
+    def get(self, args):
+        """Get everything the dashboard needs for its first paint"""
+        try:
+            invoices = get_all_invoices(
+                risk_level=args.get("risk_level"),
+                sort_by_date=args.get("sort_by_date")
+            )
+            payload = {
+                "summary": get_summary_statistics(),
+                # Same as /api/vendors, which has no vendor data behind it yet
+                "vendors": [],
+                "invoices": [serialize_invoice(invoice) for invoice in invoices],
+            }
+        except Exception as e:
+            abort(500, message=str(e))
+
+        # Raises 304 Not Modified if the client's If-None-Match matches
+        blp.set_etag(payload)
+        # Returning a Response bypasses marshmallow; DashboardBootstrapSchema still documents the payload
+        return jsonify(payload)
@@ -1,20 +1,85 @@
-from flask import current_app, send_from_directory, request, jsonify
+from flask import Response, current_app, send_from_directory, request, jsonify, stream_with_context
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort
+import asyncio
+import io
 import os
+import orjson
 from werkzeug.utils import secure_filename
 
 from ..services.database_ops import get_all_invoices, get_invoice_by_id
-from ..services.narrative_service import generate_narrative
-from ..schemas.invoice_schema import InvoiceSchema, InvoiceQueryArgsSchema, NarrativeResponseSchema
+from ..services.narrative_service import generate_narrative, generate_narratives_batch, stream_narrative
+from ..schemas.invoice_schema import InvoiceSchema, InvoiceQueryArgsSchema, NarrativeResponseSchema, InvoiceNarrativeSchema, serialize_invoice
 
 blp = Blueprint(
     "Invoices", "invoices", url_prefix="/api/invoices", description="Operations on invoices"
 )
 
 from ..services.risk_engine import calculate_risk
-from ..ingestion.ingestion import ingest_invoice_pdf
-from ..services.database_ops import add_invoice_with_risk_factors
+from ..ingestion.ingestion import ingest_invoice_pdf, ingest_invoice_pdfs_async
+from ..services.database_ops import add_invoice_with_risk_factors, add_invoices_with_risk_factors_bulk
+
+def _get_llm_credentials():
+    """Reads the Azure OpenAI credentials from the form, aborting with 400 if any are missing."""
+    api_key = request.form.get('api_key')
+    api_endpoint = request.form.get('api_endpoint')
+    deployment_name = request.form.get('deployment_name')
+    model_name = request.form.get('model_name')
+
+    if not all([api_key, api_endpoint, deployment_name, model_name]):
+        abort(400, message="Missing one or more required fields: api_key, api_endpoint, deployment_name, model_name.")
+
+    return api_key, api_endpoint, deployment_name, model_name
+
+def _save_uploaded_pdf(file):
+    """Validates an uploaded PDF and saves it to the processed directory. Returns (filename, bytes)."""
+    if file.filename == '':
+        abort(400, message="No selected file.")
+
+    if not file.filename.endswith('.pdf'):
+        abort(400, message="Invalid file type. Only PDF files are accepted.")
+
+    # Define the absolute path for the "processed" directory
+    processed_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'processed'))
+    
+    # Ensure the directory exists
+    os.makedirs(processed_dir, exist_ok=True)
+    
+    # Secure the filename and save the file
+    s_filename = secure_filename(file.filename)
+    file_path = os.path.join(processed_dir, s_filename)
+    
+    # Read the upload once; the same buffer is written to disk and handed to ingestion
+    file.stream.seek(0)
+    pdf_bytes = file.stream.read()
+    with open(file_path, 'wb') as f:
+        f.write(pdf_bytes)
+
+    return s_filename, pdf_bytes
+
+def _build_invoice_entry(ingested_data, s_filename):
+    """
+    Scores an ingested invoice and returns the (invoice_data, risk_factors_data) pair
+    the database_ops save helpers take.
+    """
+    # 2. Calculate risk
+    risk_score, risk_level, xai_factors = calculate_risk(ingested_data)
+
+    # 3. Save to DB
+    invoice_model_data = {
+        'vendor_name': ingested_data['vendor_name'],
+        'amount': ingested_data['total_amount'],
+        'invoice_date': ingested_data['invoice_date'],
+        'original_filename': s_filename,  # Use the secured filename
+        'risk_score': risk_score,
+        'risk_level': risk_level,
+        'processing_status': 'Processed'
+    }
+    return invoice_model_data, xai_factors
+
+def _store_processed_invoice(ingested_data, s_filename):
+    """Scores an ingested invoice and saves it with its risk factors."""
+    return add_invoice_with_risk_factors(*_build_invoice_entry(ingested_data, s_filename))
 
 @blp.route("/upload")
 class InvoiceUpload(MethodView):
@@ -22,74 +87,58 @@ class InvoiceUpload(MethodView):
     @blp.response(201, InvoiceSchema)
     def post(self):
         """Upload and process an invoice PDF in real-time"""
-        # --- DEBUGGING: Print the incoming request data ---
-        print(f"Received form data: {request.form}")
-        print(f"Received files: {request.files}")
-        # --- END DEBUGGING ---
-
         if 'invoice_pdf' not in request.files:
             abort(400, message="No file part in the request. Key must be 'invoice_pdf'.")
 
-        api_key = request.form.get('api_key')
-        api_endpoint = request.form.get('api_endpoint')
-        deployment_name = request.form.get('deployment_name')
-        model_name = request.form.get('model_name')
+        api_key, api_endpoint, deployment_name, model_name = _get_llm_credentials()
+        s_filename, pdf_bytes = _save_uploaded_pdf(request.files['invoice_pdf'])
 
-        if not all([api_key, api_endpoint, deployment_name, model_name]):
-            abort(400, message="Missing one or more required fields: api_key, api_endpoint, deployment_name, model_name.")
+        try:
+            # 1. Ingest the PDF from the in-memory buffer
+            ingested_data = ingest_invoice_pdf(io.BytesIO(pdf_bytes), api_key, api_endpoint, deployment_name, model_name)
+
+            new_invoice = _store_processed_invoice(ingested_data, s_filename)
+            
+            return new_invoice
 
-        file = request.files['invoice_pdf']
-        if file.filename == '':
-            abort(400, message="No selected file.")
+        except Exception as e:
+            current_app.logger.error(f"Invoice processing failed: {e}")
+            abort(500, message=str(e))
 
-        if not file.filename.endswith('.pdf'):
-            abort(400, message="Invalid file type. Only PDF files are accepted.")
+@blp.route("/upload/batch")
+class InvoiceBatchUpload(MethodView):
+    @blp.doc(summary="Upload and Process Multiple Invoice PDFs", description="Upload several invoice PDFs under the 'invoice_pdfs' key. AI extraction for all files runs concurrently.")
+    @blp.response(201, InvoiceSchema(many=True))
+    def post(self):
+        """Upload and process several invoice PDFs concurrently"""
+        files = request.files.getlist('invoice_pdfs')
+        if not files:
+            abort(400, message="No file part in the request. Key must be 'invoice_pdfs'.")
 
-        # Define the absolute path for the "processed" directory
-        processed_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'processed'))
-        
-        # Ensure the directory exists
-        os.makedirs(processed_dir, exist_ok=True)
-        
-        # Secure the filename and save the file
-        s_filename = secure_filename(file.filename)
-        file_path = os.path.join(processed_dir, s_filename)
-        
-        # Reset stream position and save the file
-        file.stream.seek(0)
-        file.save(file_path)
-        
-        # Reset stream position again before ingestion
-        file.stream.seek(0)
+        api_key, api_endpoint, deployment_name, model_name = _get_llm_credentials()
+        uploads = [_save_uploaded_pdf(file) for file in files]
 
         try:
-            # 1. Ingest the PDF from the file stream
-            ingested_data = ingest_invoice_pdf(file.stream, api_key, api_endpoint, deployment_name, model_name)
-
-            # 2. Calculate risk
-            risk_score, risk_level, xai_factors = calculate_risk(ingested_data)
-
-            # 3. Save to DB
-            invoice_model_data = {
-                'vendor_name': ingested_data['vendor_name'],
-                'amount': ingested_data['total_amount'],
-                'invoice_date': ingested_data['invoice_date'],
-                'original_filename': s_filename,  # Use the secured filename
-                'risk_score': risk_score,
-                'risk_level': risk_level,
-                'processing_status': 'Processed'
-            }
-            new_invoice = add_invoice_with_risk_factors(invoice_model_data, xai_factors)
-            
-            return new_invoice
+            # 1. Ingest all PDFs; the LLM calls overlap instead of running back to back
+            ingested_batch = asyncio.run(ingest_invoice_pdfs_async(
+                [io.BytesIO(pdf_bytes) for _, pdf_bytes in uploads],
+                api_key, api_endpoint, deployment_name, model_name
+            ))
+
+            # 2. Score the whole batch, then save it in one transaction so a failure leaves no partial batch
+            return add_invoices_with_risk_factors_bulk([
+                _build_invoice_entry(ingested_data, s_filename)
+                for ingested_data, (s_filename, _) in zip(ingested_batch, uploads)
+            ])
 
         except Exception as e:
-            current_app.logger.error(f"Invoice processing failed: {e}")
+            current_app.logger.error(f"Batch invoice processing failed: {e}")
             abort(500, message=str(e))
 
 @blp.route("/")
 class InvoiceList(MethodView):
-    @blp.doc(summary="List Invoices", description="Retrieves a list of all invoices, with optional filtering by risk level and sorting by invoice date.")
+    @blp.etag
+    @blp.doc(summary="List Invoices", description="Retrieves a list of all invoices, with optional filtering by risk level and sorting by invoice date. Send the returned ETag in If-None-Match to get a 304 when the listing is unchanged.")
     @blp.arguments(InvoiceQueryArgsSchema, location="query")
     @blp.response(200, InvoiceSchema(many=True))
     def get(self, args):
@@ -99,11 +148,16 @@ class InvoiceList(MethodView):
                 risk_level=args.get("risk_level"),
                 sort_by_date=args.get("sort_by_date")
             )
-            return invoices
+            payload = [serialize_invoice(invoice) for invoice in invoices]
         except Exception as e:
             # The debug print has been removed for production
             abort(500, message=str(e))
 
+        # Raises 304 Not Modified if the client's If-None-Match matches; kept outside the try so it isn't turned into a 500
+        blp.set_etag(payload)
+        # Returning a Response bypasses marshmallow; InvoiceSchema still documents the payload
+        return jsonify(payload)
+
 @blp.route("/<int:invoice_id>/pdf")
 class InvoicePDF(MethodView):
     @blp.doc(summary="Get Invoice PDF", description="Serves the original PDF file for a given invoice.")
@@ -130,11 +184,6 @@ class InvoiceNarrative(MethodView):
     @blp.response(200, NarrativeResponseSchema)
     def post(self, invoice_id):
         """Generate a risk narrative for a specific invoice"""
-        # --- DEBUGGING: Print the incoming request data ---
-        print(f"Narrative request raw data: {request.data}")
-        print(f"Narrative request parsed json: {request.json}")
-        # --- END DEBUGGING ---
-
         data = request.json
         api_key = data.get('api_key')
         api_endpoint = data.get('api_endpoint')
@@ -154,6 +203,74 @@ class InvoiceNarrative(MethodView):
         except Exception as e:
             abort(500, message=f"Failed to generate narrative: {str(e)}")
 
+@blp.route("/<int:invoice_id>/narrative/stream")
+class InvoiceNarrativeStream(MethodView):
+    @blp.doc(summary="Stream Invoice Narrative", description="Streams the risk narrative for a specific invoice as server-sent events: one 'token' event per generated chunk, then a 'done' event with the cleaned narrative.")
+    def post(self, invoice_id):
+        """Stream a risk narrative for a specific invoice"""
+        data = request.json
+        api_key = data.get('api_key')
+        api_endpoint = data.get('api_endpoint')
+        deployment_name = data.get('deployment_name')
+        model_name = data.get('model_name')
+
+        if not all([api_key, api_endpoint, deployment_name, model_name]):
+            abort(400, message="Missing one or more required fields in JSON body: api_key, api_endpoint, deployment_name, model_name.")
+
+        invoice = get_invoice_by_id(invoice_id)
+        if not invoice:
+            abort(404, message=f"Invoice with ID {invoice_id} not found.")
+
+        events = stream_narrative(invoice, api_key, api_endpoint, deployment_name, model_name)
+
+        def _sse_frames():
+            for event, text in events:
+                # JSON-encode the payload so newlines inside a chunk cannot break the SSE framing
+                yield f"event: {event}\ndata: {orjson.dumps(text).decode()}\n\n"
+
+        # The body is generated after this view returns; stream_with_context keeps the request and app
+        # context (and with it the DB session) alive until the last frame is sent
+        return Response(
+            stream_with_context(_sse_frames()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+@blp.route("/narratives/batch")
+class InvoiceNarrativeBatch(MethodView):
+    @blp.doc(summary="Generate Narratives for Multiple Invoices", description="Generates risk narratives for the invoices listed in 'invoice_ids'. LLM calls for all invoices run concurrently.")
+    @blp.response(200, InvoiceNarrativeSchema(many=True))
+    def post(self):
+        """Generate risk narratives for several invoices concurrently"""
+        data = request.json
+        invoice_ids = data.get('invoice_ids')
+        api_key = data.get('api_key')
+        api_endpoint = data.get('api_endpoint')
+        deployment_name = data.get('deployment_name')
+        model_name = data.get('model_name')
+
+        if not invoice_ids or not isinstance(invoice_ids, list):
+            abort(400, message="'invoice_ids' must be a non-empty list of invoice IDs.")
+
+        if not all([api_key, api_endpoint, deployment_name, model_name]):
+            abort(400, message="Missing one or more required fields in JSON body: api_key, api_endpoint, deployment_name, model_name.")
+
+        invoices = []
+        for invoice_id in invoice_ids:
+            invoice = get_invoice_by_id(invoice_id)
+            if not invoice:
+                abort(404, message=f"Invoice with ID {invoice_id} not found.")
+            invoices.append(invoice)
+
+        try:
+            narratives = asyncio.run(generate_narratives_batch(invoices, api_key, api_endpoint, deployment_name, model_name))
+            return [
+                {"invoice_id": invoice.id, "narrative": narrative}
+                for invoice, narrative in zip(invoices, narratives)
+            ]
+        except Exception as e:
+            abort(500, message=f"Failed to generate narratives: {str(e)}")
+
 @blp.route("/risk/<string:risk_level>")
 class InvoiceRiskFilter(MethodView):
     @blp.doc(summary="Filter Invoices by Risk Level", description="Retrieves a list of invoices filtered by a specific risk level.")
@@ -162,6 +279,6 @@ class InvoiceRiskFilter(MethodView):
         """Get invoices by risk level"""
         try:
             invoices = get_all_invoices(risk_level=risk_level)
-            return invoices
+            return jsonify([serialize_invoice(invoice) for invoice in invoices])
         except Exception as e:
             abort(500, message=str(e))
@@ -16,6 +16,29 @@ class InvoiceSchema(Schema):
     original_filename = fields.Str(allow_none=True) # New field
     risk_factors = fields.List(fields.Nested(RiskFactorSchema))
 
+def _float_or_none(value):
+    return float(value) if value is not None else None
+
+def serialize_invoice(invoice) -> dict:
+    """
+    Plain-dict equivalent of InvoiceSchema().dump(invoice) for the listing endpoints.
+    Skips marshmallow's per-field dispatch; keep in sync with InvoiceSchema.
+    """
+    return {
+        "invoice_id": invoice.id,
+        "vendor_name": invoice.vendor_name,
+        "amount": _float_or_none(invoice.amount),
+        "invoice_date": invoice.invoice_date.isoformat() if invoice.invoice_date is not None else None,
+        "processing_status": invoice.processing_status,
+        "risk_score": _float_or_none(invoice.risk_score),
+        "risk_level": invoice.risk_level,
+        "original_filename": invoice.original_filename,
+        "risk_factors": [
+            {"id": factor.id, "feature_name": factor.feature_name, "contribution": _float_or_none(factor.contribution)}
+            for factor in invoice.risk_factors
+        ]
+    }
+
 class InvoiceQueryArgsSchema(Schema):
     risk_level = fields.Str(
         required=False,
@@ -31,5 +54,14 @@ class DashboardSummarySchema(Schema):
     invoices_per_risk_level = fields.Dict(keys=fields.Str(), values=fields.Int(), required=True)
     average_risk_score = fields.Float(required=True)
 
+class DashboardBootstrapSchema(Schema):
+    summary = fields.Nested(DashboardSummarySchema, required=True)
+    vendors = fields.List(fields.Str(), required=True)
+    invoices = fields.List(fields.Nested(InvoiceSchema), required=True)
+
 class NarrativeResponseSchema(Schema):
     narrative = fields.Str(required=True)
+
+class InvoiceNarrativeSchema(Schema):
+    invoice_id = fields.Int(required=True)
+    narrative = fields.Str(required=True)
@@ -1,30 +1,56 @@
+import threading
+from cachetools import TTLCache
 from src.app import db
 from src.app.models.models import Invoice, RiskFactor
 from sqlalchemy import func, desc, asc
+from sqlalchemy.orm import selectinload
 
 def add_invoice_with_risk_factors(invoice_data, risk_factors_data):
     try:
         new_invoice = Invoice(**invoice_data)
-        for rf_data in risk_factors_data:
-            new_invoice.risk_factors.append(RiskFactor(**rf_data))
-        
         db.session.add(new_invoice)
+        # Flush to get the invoice id, then insert all risk factors in one executemany
+        # instead of cascading them through the relationship one by one.
+        db.session.flush()
+        db.session.bulk_save_objects([
+            RiskFactor(invoice_id=new_invoice.id, **rf_data) for rf_data in risk_factors_data
+        ])
         db.session.commit()
+        invalidate_vendor_statistics(new_invoice.vendor_name)
         return new_invoice
     except Exception as e:
         db.session.rollback()
         raise e
 
-from sqlalchemy.orm import aliased
+def add_invoices_with_risk_factors_bulk(entries):
+    """
+    Saves several invoices with their risk factors in a single transaction.
+    `entries` is a list of (invoice_data, risk_factors_data) pairs, as passed to add_invoice_with_risk_factors.
+    """
+    try:
+        new_invoices = [Invoice(**invoice_data) for invoice_data, _ in entries]
+        db.session.add_all(new_invoices)
+        db.session.flush()
+        db.session.bulk_save_objects([
+            RiskFactor(invoice_id=new_invoice.id, **rf_data)
+            for new_invoice, (_, risk_factors_data) in zip(new_invoices, entries)
+            for rf_data in risk_factors_data
+        ])
+        db.session.commit()
+        for vendor_name in {new_invoice.vendor_name for new_invoice in new_invoices}:
+            invalidate_vendor_statistics(vendor_name)
+        return new_invoices
+    except Exception as e:
+        db.session.rollback()
+        raise e
 
 def get_all_invoices(risk_level=None, sort_by_date=None):
     """
-    Gets all invoices, ensuring uniqueness even with one-to-many relationships.
+    Gets all invoices, optionally filtered by risk level and sorted by invoice date.
     """
-    # --- FIX: Use a subquery to robustly select unique invoice IDs first ---
-    # This is the most reliable way to prevent duplicates from the relationship join.
-    subquery = db.session.query(Invoice.id).distinct().subquery()
-    query = Invoice.query.join(subquery, Invoice.id == subquery.c.id)
+    # The query never joins risk_factor, so each invoice row is already unique by primary key.
+    # Risk factors are loaded with one batched SELECT ... IN (...) instead of one query per invoice.
+    query = Invoice.query.options(selectinload(Invoice.risk_factors))
 
     if risk_level:
         query = query.filter(Invoice.risk_level == risk_level)
@@ -41,16 +67,21 @@ def get_invoice_by_id(invoice_id):
     return Invoice.query.get(invoice_id)
 
 def get_summary_statistics():
-    total_invoices = db.session.query(func.count(Invoice.id)).scalar()
-    
-    risk_level_counts_query = db.session.query(
-        Invoice.risk_level, 
-        func.count(Invoice.id)
+    # One grouped round-trip; totals and the overall average are derived from the groups.
+    # count(risk_score) only counts scored invoices, matching what AVG() averages over.
+    rows = db.session.query(
+        Invoice.risk_level,
+        func.count(Invoice.id),
+        func.count(Invoice.risk_score),
+        func.avg(Invoice.risk_score)
     ).group_by(Invoice.risk_level).all()
-    
-    risk_level_counts = {level: count for level, count in risk_level_counts_query if level is not None}
-    
-    average_risk_score = db.session.query(func.avg(Invoice.risk_score)).scalar()
+
+    total_invoices = sum(count for _, count, _, _ in rows)
+    risk_level_counts = {level: count for level, count, _, _ in rows if level is not None}
+
+    scored_count = sum(scored for _, _, scored, _ in rows)
+    score_total = sum(avg * scored for _, _, scored, avg in rows if avg is not None)
+    average_risk_score = score_total / scored_count if scored_count else None
     
     return {
         "total_invoices": total_invoices or 0,
@@ -58,10 +89,25 @@ def get_summary_statistics():
         "average_risk_score": round(average_risk_score, 2) if average_risk_score is not None else 0.0
     }
 
+# Vendor aggregates change only when an invoice is added, so they are cached for a few minutes
+# and invalidated per vendor by add_invoice_with_risk_factors. Each vendor has one entry holding
+# the stats per excluded invoice, so a single pop drops everything cached for that vendor.
+_vendor_stats_cache = TTLCache(maxsize=1024, ttl=300)
+_vendor_stats_lock = threading.Lock()
+
+def invalidate_vendor_statistics(vendor_name):
+    with _vendor_stats_lock:
+        _vendor_stats_cache.pop(vendor_name, None)
+
 def get_vendor_statistics(vendor_name, current_invoice_id=None):
     """
     Calculates historical statistics for a given vendor, excluding the current invoice.
     """
+    with _vendor_stats_lock:
+        cached_stats = _vendor_stats_cache.get(vendor_name, {}).get(current_invoice_id)
+    if cached_stats is not None:
+        return cached_stats
+
     query = db.session.query(
         func.avg(Invoice.amount),
         func.max(Invoice.amount)
@@ -71,8 +117,11 @@ def get_vendor_statistics(vendor_name, current_invoice_id=None):
         query = query.filter(Invoice.id != current_invoice_id)
 
     stats = query.one()
-    
-    return {
+    vendor_stats = {
         "avg_amount": stats[0] or 0.0,
         "max_amount": stats[1] or 0.0
     }
+
+    with _vendor_stats_lock:
+        _vendor_stats_cache.setdefault(vendor_name, {})[current_invoice_id] = vendor_stats
+    return vendor_stats
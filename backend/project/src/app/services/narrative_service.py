@@ -2,148 +2,425 @@
 
 import os
 import re
-from openai import AzureOpenAI
+import asyncio
+import hashlib
+import io
+import threading
+import time
+import orjson
+from cachetools import TTLCache
 from flask import current_app
+from openai import AsyncAzureOpenAI
+from src.app.utils.openai_client import get_azure_openai_client
 from .database_ops import get_vendor_statistics
 
-def clean_narrative_text(raw_text: str) -> str:
-    """
-    Cleans model output by removing unwanted newlines, spaces, and hidden characters.
-    """
-    if not raw_text:
-        return ""
-    # Remove zero-width and non-breaking spaces
-    text = re.sub(r'[\u200B-\u200D\uFEFF]', '', raw_text)
-    # Merge characters split by newlines (e.g., 'T\nh\ni\ns' → 'This')
-    text = re.sub(r'(?<=\S)\n(?=\S)', '', text)
-    # Replace multiple newlines with a single newline
-    text = re.sub(r'\n+', '\n', text)
-    # Normalize multiple spaces
-    text = re.sub(r'[ ]{2,}', ' ', text)
-    return text.strip()
+# Prompt caching (and the cached_tokens usage field) requires 2024-10-01-preview or later.
+NARRATIVE_API_VERSION = "2024-10-01-preview"
+# Upper bound on simultaneous narrative requests in a batch, to stay under the deployment's rate limit.
+NARRATIVE_BATCH_CONCURRENCY = 10
+# Batch API jobs finish within minutes to hours; polling more often only burns requests.
+NARRATIVE_BATCH_POLL_SECONDS = 60
+_BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
 
-def generate_narrative(invoice, api_key: str, api_endpoint: str, deployment_name: str, model_name: str):
-    """
-    Generates a human-readable summary for a specific invoice using a dynamically constructed,
-    context-aware prompt and user-provided Azure OpenAI credentials.
-    """
-    try:
-        client = AzureOpenAI(
-            api_version="2024-02-01",
-            azure_endpoint=api_endpoint,
-            api_key=api_key,
-        )
-        # 1. Get historical vendor data for context
-        vendor_stats = get_vendor_statistics(invoice.vendor_name, invoice.id)
-        
-        # 2. Pre-format numbers
-        avg_amount_str = f'{vendor_stats.get("avg_amount", 0):.2f}'
-        max_amount_str = f'{vendor_stats.get("max_amount", 0):.2f}'
-        current_amount_str = f'{invoice.amount:.2f}'
-        invoice_count = vendor_stats.get("invoice_count", 0)
-
-        # 3. Calculate variance for context
-        avg_amount = vendor_stats.get("avg_amount", 0)
-        variance_pct = ((invoice.amount - avg_amount) / avg_amount * 100) if avg_amount > 0 else 0
-
-        # 4. Dynamic persona based on risk level
-        if invoice.risk_level == "High":
-            persona = """You are a senior fraud analyst with 15+ years of experience in financial crime detection. 
+# Identical prompts (same invoice, unchanged vendor history) reuse the last narrative instead of another LLM call.
+_narrative_cache = TTLCache(maxsize=512, ttl=3600)
+_narrative_cache_lock = threading.Lock()
+
+# Personas are static per risk level. Sent (with the instructions) as the system message,
+# they form an identical prefix across invoices that Azure OpenAI can serve from its prompt cache.
+_PERSONAS = {
+    "High": """You are a senior fraud analyst with 15+ years of experience in financial crime detection. 
 Your primary responsibility is to protect the organization from fraudulent transactions and financial losses.
 Your audience is the Finance Manager who needs clear, urgent, and actionable intelligence to make immediate decisions.
-Your tone should be authoritative, direct, and focused on risk mitigation."""
-            
-        elif invoice.risk_level == "Medium":
-            persona = """You are an experienced Accounts Payable specialist with expertise in payment verification and vendor management.
+Your tone should be authoritative, direct, and focused on risk mitigation.""",
+    "Medium": """You are an experienced Accounts Payable specialist with expertise in payment verification and vendor management.
 Your role is to identify anomalies that could indicate errors, policy violations, or potential fraud.
 Your audience is the AP Manager who reviews flagged transactions before approval.
-Your tone should be professional, analytical, and focused on due diligence."""
-            
-        else:
-            persona = """You are an automated compliance system providing routine verification confirmations.
+Your tone should be professional, analytical, and focused on due diligence.""",
+    "Low": """You are an automated compliance system providing routine verification confirmations.
 Your role is to document that standard controls have been satisfied.
 Your audience is the AP team who processes approved invoices.
-Your tone should be concise, affirmative, and procedural."""
-
-        # 5. Risk drivers with detailed context
-        risk_drivers = [factor.feature_name for factor in invoice.risk_factors]
-        drivers_text = ", ".join(risk_drivers) if risk_drivers else "None identified"
-        
-        # Create detailed risk context
-        risk_context = ""
-        if "amount_deviation" in drivers_text.lower():
-            risk_context += f"\n  • This invoice amount deviates significantly ({variance_pct:+.1f}%) from the vendor's historical average."
-        if "new_vendor" in drivers_text.lower():
-            risk_context += f"\n  • This is a new or infrequent vendor with limited transaction history ({invoice_count} previous invoices)."
-        if "duplicate" in drivers_text.lower():
-            risk_context += "\n  • Potential duplicate payment detected based on amount, date, or invoice number similarity."
-        if "unusual_timing" in drivers_text.lower():
-            risk_context += "\n  • Invoice submitted outside normal business patterns for this vendor."
-
-        # ✅ FIX: avoid backslashes inside the f-string expression
-        fallback_risk_text = "\n  • No specific risk patterns identified."
-        risk_text = risk_context if risk_context else fallback_risk_text
-
-        # 6. Enhanced prompt with detailed instructions
-        prompt = f"""
-{persona}
+Your tone should be concise, affirmative, and procedural.""",
+}
 
+_PROMPT_INSTRUCTIONS = """
 ## OBJECTIVE
-Generate a professional risk assessment narrative for Invoice #{invoice.id} that enables informed decision-making by the Accounts Payable team.
+Generate a professional risk assessment narrative for the invoice described in the user message that enables informed decision-making by the Accounts Payable team.
+
+---
+
+## NARRATIVE GENERATION REQUIREMENTS
+( ... rest of prompt unchanged ...)
+
+---
+"""
+
+STATIC_PREFIX = {level: f"\n{persona}\n{_PROMPT_INSTRUCTIONS}" for level, persona in _PERSONAS.items()}
 
-═══════════════════════════════════════════════════════════════════════
+# Extra context added to the prompt when a risk driver name contains the key.
+_RISK_DRIVER_NOTES = {
+    "amount_deviation": "\n  • This invoice amount deviates significantly ({variance_pct:+.1f}%) from the vendor's historical average.",
+    "new_vendor": "\n  • This is a new or infrequent vendor with limited transaction history ({invoice_count} previous invoices).",
+    "duplicate": "\n  • Potential duplicate payment detected based on amount, date, or invoice number similarity.",
+    "unusual_timing": "\n  • Invoice submitted outside normal business patterns for this vendor.",
+}
+_NO_RISK_DRIVER_NOTE = "\n  • No specific risk patterns identified."
 
-## VENDOR CONTEXT: {invoice.vendor_name}
+# Money amounts in prompts and narratives; a bound method skips re-parsing the format string per call.
+_fmt2 = '{:.2f}'.format
 
-**Historical Transaction Profile:**
+# Narrative for Low-risk invoices, generated without an LLM call (see _low_risk_narrative).
+_LOW_RISK_TEMPLATE = (
+    "Invoice {invoice_id} from {vendor} for ${amount} is classified as Low risk (score {risk_score}/100). "
+    "{history} Standard verification controls have been satisfied and no further review is required.\n"
+    "[Proceed with Payment]"
+)
+
+# Per-invoice section of the prompt, filled with str.format_map in _build_narrative_messages.
+_INVOICE_CONTEXT_TEMPLATE = """
+## VENDOR CONTEXT: {vendor_name}
+
+Historical Transaction Profile:
 - Total Previous Invoices: {invoice_count}
-- Average Invoice Amount: ${avg_amount_str}
-- Highest Previous Invoice: ${max_amount_str}
-- Payment History: {vendor_stats.get("payment_history", "No prior issues documented")}
-- Vendor Relationship: {vendor_stats.get("relationship_duration", "Established vendor")}
+- Average Invoice Amount: ${avg_amount}
+- Highest Previous Invoice: ${max_amount}
+- Payment History: {payment_history}
+- Vendor Relationship: {relationship_duration}
 
-═══════════════════════════════════════════════════════════════════════
+---
 
 ## CURRENT INVOICE ANALYSIS
 
-**Transaction Details:**
-- Invoice ID: {invoice.id}
-- Vendor Name: {invoice.vendor_name}
-- Invoice Amount: ${current_amount_str}
-- Invoice Date: {invoice.invoice_date.strftime('%B %d, %Y')}
+Transaction Details:
+- Invoice ID: {invoice_id}
+- Vendor Name: {vendor_name}
+- Invoice Amount: ${amount}
+- Invoice Date: {invoice_date}
 - Variance from Average: {variance_pct:+.1f}%
 
-**Risk Assessment:**
-- Risk Score: {invoice.risk_score}/100
-- Risk Classification: {invoice.risk_level}
+Risk Assessment:
+- Risk Score: {risk_score}/100
+- Risk Classification: {risk_level}
 - Primary Risk Indicators: {drivers_text}
 
-**Risk Factor Details:**{risk_text}
+Risk Factor Details:{risk_text}
+"""
 
-═══════════════════════════════════════════════════════════════════════
+# Compiled once at import; clean_narrative_text runs on every generated narrative.
+_ZW_TABLE = str.maketrans('', '', '\u200b\u200c\u200d\ufeff')
+_SPLIT_RE = re.compile(r'(?<=\S)\n(?=\S)')
+_MULTI_NL_RE = re.compile(r'\n+')
 
-## NARRATIVE GENERATION REQUIREMENTS
-( ... rest of prompt unchanged ...)
-"""
+def clean_narrative_text(raw_text: str) -> str:
+    """
+    Cleans model output by removing unwanted newlines, spaces, and hidden characters.
+    """
+    if not raw_text:
+        return ""
+    # Remove zero-width and non-breaking spaces
+    text = raw_text.translate(_ZW_TABLE)
+    # Most narratives are already clean, so skip the regex passes when a cheap `in` test rules them out
+    if '\n' in text:
+        # Merge characters split by newlines (e.g., 'T\nh\ni\ns' → 'This')
+        text = _SPLIT_RE.sub('', text)
+        # Replace multiple newlines with a single newline
+        if '\n\n' in text:
+            text = _MULTI_NL_RE.sub('\n', text)
+    # Normalize multiple spaces; a literal replace beats the regex engine and rarely needs more than two passes
+    while '  ' in text:
+        text = text.replace('  ', ' ')
+    return text.strip()
+
+def _build_narrative_messages(invoice) -> list:
+    """Builds the chat messages for an invoice narrative: cached static prefix + per-invoice details."""
+    # Read each invoice attribute once
+    invoice_id = invoice.id
+    vendor_name = invoice.vendor_name
+    amount = invoice.amount
+
+    # 1. Get historical vendor data for context, one lookup per key
+    vendor_stats = get_vendor_statistics(vendor_name, invoice_id)
+    avg_amount = vendor_stats.get("avg_amount", 0)
+    max_amount = vendor_stats.get("max_amount", 0)
+    invoice_count = vendor_stats.get("invoice_count", 0)
+    payment_history = vendor_stats.get("payment_history", "No prior issues documented")
+    relationship_duration = vendor_stats.get("relationship_duration", "Established vendor")
+    
+    # 2. Pre-format numbers
+    avg_amount_str = _fmt2(avg_amount)
+    max_amount_str = _fmt2(max_amount)
+    current_amount_str = _fmt2(amount)
+
+    # 3. Calculate variance for context
+    variance_pct = ((amount - avg_amount) / avg_amount * 100) if avg_amount > 0 else 0
+
+    # 4. Static system prompt (persona + instructions) based on risk level
+    static_prefix = STATIC_PREFIX.get(invoice.risk_level, STATIC_PREFIX["Low"])
+
+    # 5. Risk drivers with detailed context
+    risk_drivers = [factor.feature_name for factor in invoice.risk_factors]
+    drivers_text = ", ".join(risk_drivers) if risk_drivers else "None identified"
+    
+    # Create detailed risk context; lowercase each driver once instead of per check
+    driver_names = {driver.lower() for driver in risk_drivers}
+    risk_context = "".join(
+        note.format(variance_pct=variance_pct, invoice_count=invoice_count)
+        for token, note in _RISK_DRIVER_NOTES.items()
+        if any(token in driver for driver in driver_names)
+    )
+
+    risk_text = risk_context or _NO_RISK_DRIVER_NOTE
+
+    # 6. Per-invoice data goes in the user message so the system prompt can be served from the prompt cache
+    dynamic_suffix = _INVOICE_CONTEXT_TEMPLATE.format_map({
+        "vendor_name": vendor_name,
+        "invoice_count": invoice_count,
+        "avg_amount": avg_amount_str,
+        "max_amount": max_amount_str,
+        "payment_history": payment_history,
+        "relationship_duration": relationship_duration,
+        "invoice_id": invoice_id,
+        "amount": current_amount_str,
+        "invoice_date": invoice.invoice_date.strftime('%B %d, %Y'),
+        "variance_pct": variance_pct,
+        "risk_score": invoice.risk_score,
+        "risk_level": invoice.risk_level,
+        "drivers_text": drivers_text,
+        "risk_text": risk_text,
+    })
+    return [
+        {"role": "system", "content": static_prefix},
+        {"role": "user", "content": dynamic_suffix},
+    ]
+
+def _narrative_from_response(response) -> str:
+    """Logs prompt-cache usage and returns the cleaned narrative, raising if the model returned nothing."""
+    usage = getattr(response, "usage", None)
+    prompt_details = getattr(usage, "prompt_tokens_details", None)
+    if usage is not None:
+        cached_tokens = getattr(prompt_details, "cached_tokens", None) or 0
+        current_app.logger.info("Narrative prompt cache: %s/%s prompt tokens served from cache.", cached_tokens, usage.prompt_tokens)
+
+    narrative = response.choices[0].message.content
+    narrative = clean_narrative_text(narrative)
 
-        messages = [{"role": "user", "content": prompt}]
+    if narrative:
+        return narrative
+    else:
+        current_app.logger.error("Azure OpenAI model returned no content.")
+        raise Exception("Failed to generate narrative; the model returned an empty response.")
 
+def _narrative_cache_key(api_endpoint: str, model_name: str, messages: list) -> str:
+    return hashlib.sha256(orjson.dumps([api_endpoint, model_name, messages])).hexdigest()
+
+def _get_cached_narrative(cache_key: str):
+    with _narrative_cache_lock:
+        return _narrative_cache.get(cache_key)
+
+def _store_cached_narrative(cache_key: str, narrative: str):
+    with _narrative_cache_lock:
+        _narrative_cache[cache_key] = narrative
+
+def _low_risk_narrative(invoice) -> str:
+    """Fills the Low-risk template locally; these narratives are routine enough not to need the LLM."""
+    avg_amount = get_vendor_statistics(invoice.vendor_name, invoice.id).get("avg_amount", 0)
+    if avg_amount > 0:
+        history = f"The vendor's historical average invoice amount is ${_fmt2(avg_amount)}."
+    else:
+        history = "No prior invoices from this vendor are on record."
+    return _LOW_RISK_TEMPLATE.format(
+        invoice_id=invoice.id,
+        vendor=invoice.vendor_name,
+        amount=_fmt2(invoice.amount),
+        risk_score=invoice.risk_score,
+        history=history,
+    )
+
+def _narrative_failure_text(invoice) -> str:
+    return f"Narrative generation failed due to an internal error. Please review invoice {invoice.id} manually."
+
+def generate_narrative(invoice, api_key: str, api_endpoint: str, deployment_name: str, model_name: str):
+    """
+    Generates a human-readable summary for a specific invoice using a dynamically constructed,
+    context-aware prompt and user-provided Azure OpenAI credentials.
+    """
+    if invoice.risk_level == "Low":
+        return _low_risk_narrative(invoice)
+
+    messages = _build_narrative_messages(invoice)
+
+    cache_key = _narrative_cache_key(api_endpoint, model_name, messages)
+    cached_narrative = _get_cached_narrative(cache_key)
+    if cached_narrative is not None:
+        return cached_narrative
+
+    # Rate limits and connection errors are retried by the SDK (two retries by default, with backoff);
+    # only a call that still fails (or returns nothing) falls back to the manual-review text.
+    client = get_azure_openai_client(api_endpoint, api_key, NARRATIVE_API_VERSION)
+    try:
         response = client.chat.completions.create(
             model=model_name,
             messages=messages,
             temperature=0.3,
             max_tokens=500
         )
-        
-        narrative = response.choices[0].message.content
-        narrative = clean_narrative_text(narrative)
+        narrative = _narrative_from_response(response)
+    except Exception as e:
+        current_app.logger.error("An unexpected error occurred while generating the narrative: %s", e)
+        return _narrative_failure_text(invoice)
 
-        if narrative:
-            return narrative
-        else:
-            current_app.logger.error("Azure OpenAI model returned no content.")
-            raise Exception("Failed to generate narrative; the model returned an empty response.")
+    _store_cached_narrative(cache_key, narrative)
+    return narrative
 
+def stream_narrative(invoice, api_key: str, api_endpoint: str, deployment_name: str, model_name: str):
+    """
+    Returns an iterator of ("token", text) events, produced while the model generates the narrative,
+    followed by one ("done", narrative) event carrying the cleaned text. Low-risk and cached
+    narratives skip straight to the "done" event.
+    """
+    if invoice.risk_level == "Low":
+        return iter([("done", _low_risk_narrative(invoice))])
+
+    # All DB reads (risk factors, vendor history) happen here, before the generator starts, so a DB error
+    # surfaces as a normal error response instead of mid-stream and no query runs during the slow LLM call
+    messages = _build_narrative_messages(invoice)
+
+    cache_key = _narrative_cache_key(api_endpoint, model_name, messages)
+    cached_narrative = _get_cached_narrative(cache_key)
+    if cached_narrative is not None:
+        return iter([("done", cached_narrative)])
+
+    return _stream_completion(messages, cache_key, _narrative_failure_text(invoice), api_key, api_endpoint, model_name)
+
+def _stream_completion(messages: list, cache_key: str, failure_text: str, api_key: str, api_endpoint: str, model_name: str):
+    client = get_azure_openai_client(api_endpoint, api_key, NARRATIVE_API_VERSION)
+    pieces = []
+    try:
+        stream = client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=0.3,
+            max_tokens=500,
+            stream=True
+        )
+        for chunk in stream:
+            piece = chunk.choices[0].delta.content if chunk.choices else None
+            if piece:
+                pieces.append(piece)
+                yield "token", piece
     except Exception as e:
-        current_app.logger.error(f"An unexpected error occurred while generating the narrative: {e}")
-        return f"Narrative generation failed due to an internal error. Please review invoice {invoice.id} manually."
+        current_app.logger.error("An unexpected error occurred while streaming the narrative: %s", e)
+        yield "done", failure_text
+        return
+
+    narrative = clean_narrative_text("".join(pieces))
+    if not narrative:
+        current_app.logger.error("Azure OpenAI model returned no content.")
+        yield "done", failure_text
+        return
+
+    _store_cached_narrative(cache_key, narrative)
+    yield "done", narrative
+
+async def generate_narratives_batch(invoices: list, api_key: str, api_endpoint: str, deployment_name: str, model_name: str, concurrency: int = NARRATIVE_BATCH_CONCURRENCY) -> list:
+    """
+    Generates narratives for several invoices with overlapping LLM calls, at most `concurrency`
+    in flight. Returns narratives in input order; a failed invoice gets the usual fallback text.
+    """
+    # Low-risk narratives are templated locally; only the remaining invoices go to the LLM
+    narratives = {invoice.id: _low_risk_narrative(invoice) for invoice in invoices if invoice.risk_level == "Low"}
+    llm_invoices = [invoice for invoice in invoices if invoice.id not in narratives]
+
+    # Vendor stats come from the DB session, which is bound to this thread, so prompts are built up front
+    batch_messages = [_build_narrative_messages(invoice) for invoice in llm_invoices]
+    cache_keys = [_narrative_cache_key(api_endpoint, model_name, messages) for messages in batch_messages]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # Async clients are bound to the running event loop, so one is created per batch instead of cached
+    async with AsyncAzureOpenAI(api_version=NARRATIVE_API_VERSION, azure_endpoint=api_endpoint, api_key=api_key) as client:
+        async def _one(messages, cache_key):
+            cached_narrative = _get_cached_narrative(cache_key)
+            if cached_narrative is not None:
+                return cached_narrative
+            async with semaphore:
+                return await client.chat.completions.create(
+                    model=model_name,
+                    messages=messages,
+                    temperature=0.3,
+                    max_tokens=500
+                )
+
+        responses = await asyncio.gather(*[_one(messages, cache_key) for messages, cache_key in zip(batch_messages, cache_keys)], return_exceptions=True)
+
+    for invoice, cache_key, response in zip(llm_invoices, cache_keys, responses):
+        try:
+            if isinstance(response, Exception):
+                raise response
+            if isinstance(response, str):
+                narratives[invoice.id] = response
+                continue
+            narrative = _narrative_from_response(response)
+            _store_cached_narrative(cache_key, narrative)
+            narratives[invoice.id] = narrative
+        except Exception as e:
+            current_app.logger.error("An unexpected error occurred while generating the narrative for invoice %s: %s", invoice.id, e)
+            narratives[invoice.id] = _narrative_failure_text(invoice)
+    return [narratives[invoice.id] for invoice in invoices]
+
+def generate_narratives_via_batch_api(invoices: list, api_key: str, api_endpoint: str, deployment_name: str, poll_interval: int = NARRATIVE_BATCH_POLL_SECONDS) -> dict:
+    """
+    Generates narratives for a backfill through the Azure OpenAI Batch API, which is billed at
+    half the real-time price. Blocks until the job finishes and returns {invoice_id: narrative};
+    raises if the job does not complete. `deployment_name` must be a Global Batch deployment.
+    """
+    # Low-risk narratives are templated locally and never submitted
+    narratives = {invoice.id: _low_risk_narrative(invoice) for invoice in invoices if invoice.risk_level == "Low"}
+    llm_invoices = [invoice for invoice in invoices if invoice.id not in narratives]
+    if not llm_invoices:
+        return narratives
+
+    client = get_azure_openai_client(api_endpoint, api_key, NARRATIVE_API_VERSION)
+
+    # 1. One JSONL request per invoice; custom_id maps results back to invoices
+    lines = [
+        orjson.dumps({
+            "custom_id": str(invoice.id),
+            "method": "POST",
+            "url": "/chat/completions",
+            "body": {
+                "model": deployment_name,
+                "messages": _build_narrative_messages(invoice),
+                "temperature": 0.3,
+                "max_tokens": 500
+            }
+        })
+        for invoice in llm_invoices
+    ]
+    batch_file = client.files.create(file=("narratives.jsonl", io.BytesIO(b"\n".join(lines))), purpose="batch")
+
+    # 2. Submit the job and wait for it to finish
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint="/chat/completions", completion_window="24h")
+    current_app.logger.info("Submitted narrative batch %s for %d invoices.", batch.id, len(llm_invoices))
+    while batch.status not in _BATCH_TERMINAL_STATUSES:
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+
+    # A failed, expired or cancelled job has no results to fall back from
+    if batch.status != "completed" or not batch.output_file_id:
+        current_app.logger.error("Narrative batch %s ended with status '%s'.", batch.id, batch.status)
+        raise Exception(f"Narrative batch {batch.id} ended with status '{batch.status}' and produced no output.")
+
+    # 3. Collect results; individual requests that failed get the usual fallback text
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        result = orjson.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            current_app.logger.error("Batch narrative for invoice %s failed: %s", result.get('custom_id'), result.get('error') or response)
+            continue
+        narrative = clean_narrative_text(response["body"]["choices"][0]["message"]["content"])
+        if narrative:
+            narratives[int(result["custom_id"])] = narrative
+
+    return {invoice.id: narratives.get(invoice.id) or _narrative_failure_text(invoice) for invoice in invoices}
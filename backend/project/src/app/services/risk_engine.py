@@ -1,5 +1,14 @@
+import re
+import bisect
 from datetime import date
 
+# Vendor-name keywords for the 'Vendor Type' factor; add alternatives here as rules grow.
+_VENDOR_KW_RE = re.compile(r'consulting|services', re.IGNORECASE)
+
+# Inclusive upper bounds of each risk band; scores above the last bound are 'High'.
+_THRESHOLDS = (30, 60)
+_LEVELS = ('Low', 'Medium', 'High')
+
 def calculate_risk(invoice_data: dict) -> tuple:
     """
     Simulates an ML model by assigning a risk score to an invoice and generating XAI factors.
@@ -23,8 +32,7 @@ def calculate_risk(invoice_data: dict) -> tuple:
             'contribution': points
         })
 
-    vendor_name = invoice_data.get('vendor_name', '').lower()
-    if 'consulting' in vendor_name or 'services' in vendor_name:
+    if _VENDOR_KW_RE.search(invoice_data.get('vendor_name', '')):
         points = 30
         risk_score += points
         xai_factors.append({
@@ -41,11 +49,7 @@ def calculate_risk(invoice_data: dict) -> tuple:
             'contribution': points
         })
 
-    if risk_score <= 30:
-        risk_level = 'Low'
-    elif 31 <= risk_score <= 60:
-        risk_level = 'Medium'
-    else:
-        risk_level = 'High'
+    # bisect_left keeps the bounds inclusive: 30 is Low, 60 is Medium
+    risk_level = _LEVELS[bisect.bisect_left(_THRESHOLDS, risk_score)]
 
     return risk_score, risk_level, xai_factors
@@ -0,0 +1,17 @@
+from functools import lru_cache
+from openai import AzureOpenAI
+
+DEFAULT_API_VERSION = "2024-02-01"
+
+@lru_cache(maxsize=32)
+def get_azure_openai_client(api_endpoint: str, api_key: str, api_version: str = DEFAULT_API_VERSION) -> AzureOpenAI:
+    """
+    Returns a shared AzureOpenAI client for the given endpoint/key pair.
+    Reusing the client keeps its underlying httpx connection pool alive, so
+    repeated calls skip the TCP/TLS handshake.
+    """
+    return AzureOpenAI(
+        api_version=api_version,
+        azure_endpoint=api_endpoint,
+        api_key=api_key,
+    )
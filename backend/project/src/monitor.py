@@ -1,6 +1,11 @@
+import io
+import logging
 import os
 import sys
 import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
@@ -13,60 +18,114 @@ if project_dir not in sys.path:
 from src.app import create_app, db
 from src.app.ingestion.ingestion import ingest_invoice_pdf
 from src.app.services.risk_engine import calculate_risk
-from src.app.services.database_ops import add_invoice_with_risk_factors
+from src.app.services.database_ops import add_invoices_with_risk_factors_bulk
 
 # Define the directories
 WATCH_DIR = os.path.join(os.path.dirname(__file__), 'invoice_inbox')
 PROCESSED_DIR = os.path.join(os.path.dirname(__file__), 'processed')
 FAILED_DIR = os.path.join(os.path.dirname(__file__), 'failed')
 
+# PDFs arriving within this window of each other are processed as one batch
+DEBOUNCE_SECONDS = 0.5
+MAX_WORKERS = os.cpu_count() or 1
+
 # Create a Flask app instance for the database context
 app = create_app()
 
+logger = logging.getLogger(__name__)
+
+def _init_worker():
+    """Pushes one app context per worker process (ingestion logs through current_app)."""
+    app.app_context().push()
+
+def _ingest_one(pdf_path, credentials):
+    """Runs in a worker process: reads a PDF and extracts its invoice data."""
+    with open(pdf_path, 'rb') as f:
+        return ingest_invoice_pdf(io.BytesIO(f.read()), *credentials)
+
+def _get_llm_credentials():
+    """Reads the Azure OpenAI credentials from the environment; the monitor runs unattended."""
+    names = ("AZURE_OPENAI_API_KEY", "AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_DEPLOYMENT", "AZURE_OPENAI_MODEL")
+    credentials = tuple(os.environ.get(name) for name in names)
+    if not all(credentials):
+        sys.exit(f"Missing one or more required environment variables: {', '.join(names)}.")
+    return credentials
+
 class InvoiceEventHandler(FileSystemEventHandler):
+    def __init__(self, pool, credentials):
+        super().__init__()
+        self.pool = pool
+        self.credentials = credentials
+        self._queue = queue.Queue()
+        threading.Thread(target=self._dispatch_loop, daemon=True).start()
+
     def on_created(self, event):
         """Called when a file or directory is created."""
         if not event.is_directory and event.src_path.endswith('.pdf'):
-            print(f"New PDF detected: {os.path.basename(event.src_path)}")
-            self.process_invoice(event.src_path)
+            logger.info("New PDF detected: %s", os.path.basename(event.src_path))
+            self._queue.put(event.src_path)
 
-    def process_invoice(self, pdf_path):
-        """Processes a single invoice PDF with detailed logging."""
-        print(f"   [1/5] Starting processing for {os.path.basename(pdf_path)}")
-        try:
-            with app.app_context():
-                # 1. Ingest the PDF
-                print("   [2/5] Ingesting PDF data...")
-                ingested_data = ingest_invoice_pdf(pdf_path)
-                print("   [3/5] Ingestion successful. Assessing risk...")
-
-                # 2. Calculate risk and get XAI factors
-                risk_score, risk_level, xai_factors = calculate_risk(ingested_data)
-                print(f"   [4/5] Risk assessment complete. Level: {risk_level}, Score: {risk_score}")
-
-                # 3. Prepare data for database insertion
-                invoice_model_data = {
-                    'vendor_name': ingested_data['vendor_name'],
-                    'amount': ingested_data['total_amount'],
-                    'invoice_date': ingested_data['invoice_date'],
-                    'original_filename': os.path.basename(pdf_path),
-                    'risk_score': risk_score,
-                    'risk_level': risk_level,
-                    'processing_status': 'Processed'
-                }
-
-                # 4. Save to DB using the dedicated database operation
-                print("   [5/5] Saving invoice and risk factors to database...")
-                add_invoice_with_risk_factors(invoice_model_data, xai_factors)
-                
-                print(f"   [SUCCESS] Successfully stored invoice.")
-                self.move_file(pdf_path, PROCESSED_DIR)
+    def _dispatch_loop(self):
+        """Collects PDFs that arrive close together and hands them to process_invoices as a batch."""
+        # App contexts are per thread, so this thread pushes one for its lifetime instead of one per batch.
+        # The scoped DB session lives as long as the context and commits once per batch.
+        app.app_context().push()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + DEBOUNCE_SECONDS
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.process_invoices(batch)
+
+    def process_invoices(self, pdf_paths):
+        """Processes a batch of invoice PDFs with detailed logging."""
+        logger.debug("[1/4] Starting processing for %d invoice(s)", len(pdf_paths))
+
+        # 1. Ingest the PDFs in parallel; a failed file does not hold back the rest of the batch
+        futures = {pdf_path: self.pool.submit(_ingest_one, pdf_path, self.credentials) for pdf_path in pdf_paths}
+        ingested = []
+        for pdf_path, future in futures.items():
+            try:
+                ingested.append((pdf_path, future.result()))
+            except Exception as e:
+                logger.error("[FAILED] Ingestion of %s failed: %s", os.path.basename(pdf_path), e)
+                self.move_file(pdf_path, FAILED_DIR, "error")
+
+        if not ingested:
+            return
+
+        # 2-3. Calculate risk and get XAI factors, then prepare data for database insertion
+        logger.debug("[2/4] Ingested %d invoice(s). Assessing risk...", len(ingested))
+        entries = []
+        for pdf_path, ingested_data in ingested:
+            risk_score, risk_level, xai_factors = calculate_risk(ingested_data)
+            invoice_model_data = {
+                'vendor_name': ingested_data['vendor_name'],
+                'amount': ingested_data['total_amount'],
+                'invoice_date': ingested_data['invoice_date'],
+                'original_filename': os.path.basename(pdf_path),
+                'risk_score': risk_score,
+                'risk_level': risk_level,
+                'processing_status': 'Processed'
+            }
+            entries.append((invoice_model_data, xai_factors))
 
+        # 4. Save the whole batch in one transaction
+        logger.debug("[3/4] Saving invoices and risk factors to database...")
+        try:
+            add_invoices_with_risk_factors_bulk(entries)
         except Exception as e:
-            print(f"   [FAILED] An error occurred: {e}")
-            import traceback
-            traceback.print_exc()
-            self.move_file(pdf_path, FAILED_DIR, "error")
+            logger.exception("[FAILED] An error occurred: %s", e)
+            for pdf_path, _ in ingested:
+                self.move_file(pdf_path, FAILED_DIR, "error")
+            return
+
+        logger.info("[4/4] [SUCCESS] Successfully stored %d invoice(s).", len(entries))
+        for pdf_path, _ in ingested:
+            self.move_file(pdf_path, PROCESSED_DIR)
 
     def move_file(self, src_path, dest_dir, prefix=""):
         """Moves a file to a destination directory, adding a prefix if needed."""
@@ -77,33 +136,48 @@ class InvoiceEventHandler(FileSystemEventHandler):
         new_filename = f"{prefix}_{filename}" if prefix else filename
         dest_path = os.path.join(dest_dir, new_filename)
         
-        # Ensure destination filename is unique
-        count = 1
-        while os.path.exists(dest_path):
-            name, ext = os.path.splitext(new_filename)
-            dest_path = os.path.join(dest_dir, f"{name}_{count}{ext}")
-            count += 1
-            
-        os.rename(src_path, dest_path)
-        print(f"Moved '{filename}' to '{dest_dir}'")
+        # Reserve a unique destination name atomically; O_EXCL fails if another file already took it
+        name, ext = os.path.splitext(new_filename)
+        count = 0
+        while True:
+            try:
+                os.close(os.open(dest_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+                break
+            except FileExistsError:
+                count += 1
+                dest_path = os.path.join(dest_dir, f"{name}_{count}{ext}")
+
+        # Overwrite the empty placeholder; os.replace also overwrites on Windows, unlike os.rename
+        try:
+            os.replace(src_path, dest_path)
+        except OSError:
+            # Don't leave an empty placeholder behind if the move itself failed
+            os.remove(dest_path)
+            raise
+        logger.info("Moved '%s' to '%s'", filename, dest_dir)
 
 
 if __name__ == "__main__":
-    print(f"Starting invoice monitor. Watching directory: {WATCH_DIR}")
+    logging.basicConfig(level=os.environ.get("MONITOR_LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(message)s")
+    logger.info("Starting invoice monitor. Watching directory: %s", WATCH_DIR)
     
     # Ensure directories exist
     for d in [WATCH_DIR, PROCESSED_DIR, FAILED_DIR]:
         os.makedirs(d, exist_ok=True)
 
-    event_handler = InvoiceEventHandler()
-    observer = Observer()
-    observer.schedule(event_handler, WATCH_DIR, recursive=False)
-    observer.start()
+    credentials = _get_llm_credentials()
 
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
-    print("Invoice monitor stopped.")
\ No newline at end of file
+    # One pool for the monitor's lifetime; each worker keeps its own app context
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=_init_worker) as pool:
+        event_handler = InvoiceEventHandler(pool, credentials)
+        observer = Observer()
+        observer.schedule(event_handler, WATCH_DIR, recursive=False)
+        observer.start()
+
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            observer.stop()
+        observer.join()
+    logger.info("Invoice monitor stopped.")
\ No newline at end of file
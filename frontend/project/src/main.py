@@ -1,26 +1,38 @@
 # FIX: Ensured all required modules are imported for a self-contained and executable script.
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import logging
+import json
+import time
+from contextlib import contextmanager
 import pandas as pd
 from datetime import datetime
 # FIX: Imported specific types from the 'typing' module for clear and robust function signatures.
-from typing import List, Dict, Any, Optional
-# FIX: Imported streamlit_autorefresh to implement non-blocking UI updates, addressing a critical performance issue.
-from streamlit_autorefresh import st_autorefresh
+from typing import List, Dict, Any, Optional, Iterator, Tuple
 from dotenv import load_dotenv
-import matplotlib.pyplot as plt
 
 # --- Configuration ---
-# Load environment variables from .env file
-load_dotenv()
+@st.cache_resource(show_spinner=False)
+def _init_once() -> bool:
+    """
+    One-time process setup. Streamlit re-executes this script on every rerun, so caching the
+    call keeps the .env file from being re-read and logging from being reconfigured each time.
+    """
+    # Load environment variables from .env file
+    load_dotenv()
 
-# FIX: Configured basic logging to ensure application events are captured for monitoring and debugging.
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+    # FIX: Configured basic logging to ensure application events are captured for monitoring and debugging.
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    return True
+
+# Runs before the settings below are read from the environment
+_init_once()
 
 # FIX: Securely retrieve secrets and configuration, preventing hardcoded credentials.
 # API_KEY = st.secrets.get("API_KEY", os.getenv("API_KEY"))
@@ -28,6 +40,17 @@ logging.basicConfig(
 # BACKEND_API_URL configuration, enhancing security by preventing accidental insecure deployments.
 BACKEND_API_URL = "http://127.0.0.1:5000"
 
+# Cache lifetimes for backend reads (any value st.cache_data accepts, e.g. "5m"); overridable for ops tuning.
+# The vendor list is persisted to disk, where st.cache_data ignores ttl; it expires by rolling this window instead.
+CACHE_TTL_VENDORS_SECONDS = int(os.getenv("CACHE_TTL_VENDORS_SECONDS", "3600"))
+CACHE_TTL_INVOICES = os.getenv("CACHE_TTL_INVOICES", "2m")
+
+# Render AI narratives token by token from the backend's SSE endpoint; set to 0 to fall back to the blocking POST.
+STREAMING_NARRATIVE = os.getenv("STREAMING_NARRATIVE", "1") == "1"
+
+# Polling interval for the summary cards and invoice review while auto-refresh is enabled.
+AUTO_REFRESH_INTERVAL = "30s"
+
 # --- Constants for Session State and Widget Keys ---
 # FIX: Defined constants for session state and widget keys to prevent typos and improve code maintainability.
 SESSION_STATE_INVOICE_ID = "selected_invoice_id"
@@ -38,10 +61,26 @@ SESSION_STATE_API_KEY = "api_key" # New session state for the API key
 SESSION_STATE_API_ENDPOINT = "api_endpoint"
 SESSION_STATE_DEPLOYMENT_NAME = "deployment_name"
 SESSION_STATE_MODEL_NAME = "model_name"
+SESSION_STATE_NARRATIVE_INFLIGHT = "narrative_inflight"
 WIDGET_KEY_INVOICE_SELECTION = "invoice_selection"
 WIDGET_KEY_VENDOR_FILTER = "vendor_filter"
+WIDGET_KEY_RISK_FILTER = "risk_level_filter"
 WIDGET_KEY_GENERATE_BUTTON = "generate_narrative_button"
 
+# Risk level labels shown in the invoice table
+_RISK_DISPLAY = {"High": "High 🔴", "Medium": "Medium 🟠", "Low": "Low 🟢"}
+
+# Columns the dashboard uses from the invoice API, with explicit dtypes so pandas skips inference.
+# Invoice IDs stay integers because the backend routes take integer IDs; amounts stay float64 so cents survive.
+_INVOICE_DTYPES = {
+    "invoice_id": "int64",
+    "vendor_name": "category",
+    "invoice_date": "datetime64[ns]",
+    "amount": "float64",
+    "risk_score": "float32",
+    "risk_level": "category",
+}
+
 # --- Page Setup ---
 st.set_page_config(
     page_title="Cognitive Invoice Risk Management Dashboard",
@@ -50,6 +89,32 @@ st.set_page_config(
 )
 
 # --- API Communication ---
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """
+    Returns a pooled HTTP session shared across reruns and user sessions, so requests to the
+    backend reuse open connections instead of opening a new one per call.
+    Only idempotent requests are retried (urllib3's default excludes POST).
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource
+def get_etag_store() -> Dict[Any, Tuple[str, Any]]:
+    """
+    Returns the process-wide map of (endpoint, params) -> (ETag, last response body) used for
+    conditional GETs. Held as a cached resource because a module-level dict would be rebuilt
+    on every rerun, when Streamlit re-executes this script.
+    """
+    return {}
+
 # FIX: Corrected the type hint to use the modern union syntax `|` and ensured the function is fully defined.
 def _api_get_request(endpoint: str, params: Optional[Dict[str, Any]] = None) -> Optional[List[Dict[str, Any]] | Dict[str, Any]]:
     """
@@ -62,14 +127,26 @@ def _api_get_request(endpoint: str, params: Optional[Dict[str, Any]] = None) ->
 
     Returns:
         A dictionary or list with the JSON response from the API if successful, otherwise None.
+        When the endpoint returns an ETag, later calls revalidate with If-None-Match and reuse
+        the stored body on a 304 Not Modified.
     """
     try:
         url = f"{BACKEND_API_URL}{endpoint}"
         headers = {}  # {"Authorization": f"Bearer {API_KEY}"}
+        etag_key = (endpoint, frozenset((params or {}).items()))
+        previous = get_etag_store().get(etag_key)
+        if previous:
+            headers["If-None-Match"] = previous[0]
         # FIX: Added a timeout to the request to prevent the app from hanging indefinitely.
-        response = requests.get(url, headers=headers, params=params, timeout=10)
+        response = get_http_session().get(url, headers=headers, params=params, timeout=10)
+        if response.status_code == 304 and previous:
+            return previous[1]
         response.raise_for_status() # FIX: Ensures that HTTP errors (4xx or 5xx) are raised as exceptions.
-        return response.json()
+        data = response.json()
+        etag = response.headers.get("ETag")
+        if etag:
+            get_etag_store()[etag_key] = (etag, data)
+        return data
     except requests.exceptions.RequestException as e:
         # FIX: Implemented comprehensive error handling and logging for API requests to aid in debugging.
         logging.error(f"API request to {url} failed: {e}", exc_info=True)
@@ -84,7 +161,7 @@ def _api_post_request(endpoint: str, json_data: Optional[Dict[str, Any]] = None,
         if api_key:
             headers["Authorization"] = f"Bearer {api_key}"
 
-        response = requests.post(url, headers=headers, json=json_data, timeout=30)
+        response = get_http_session().post(url, headers=headers, json=json_data, timeout=30)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.HTTPError as e:
@@ -96,6 +173,39 @@ def _api_post_request(endpoint: str, json_data: Optional[Dict[str, Any]] = None,
         st.error(f"Failed to send data to the backend API. Please try again.")
         return None
 
+def _api_post_stream(endpoint: str, json_data: Optional[Dict[str, Any]] = None, api_key: Optional[str] = None) -> Iterator[Tuple[str, Any]]:
+    """
+    Makes an API POST request whose response is a server-sent event stream and yields an
+    (event, data) pair per frame as it arrives. `data` is JSON-decoded.
+    """
+    try:
+        url = f"{BACKEND_API_URL}{endpoint}"
+        headers = {}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+
+        with get_http_session().post(url, headers=headers, json=json_data, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            event = "message"
+            # Split raw bytes on newlines and decode per line; decode_unicode=True would split on
+            # str.splitlines() boundaries, which include U+2028/U+2029 that orjson leaves unescaped
+            for raw_line in response.iter_lines():
+                line = raw_line.decode("utf-8")
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    yield event, json.loads(line[len("data:"):].strip())
+                    event = "message"
+    except requests.exceptions.HTTPError as e:
+        logging.error(f"API streaming request to {url} failed: {e}", exc_info=True)
+        st.error(f"Failed to send data to the backend API: {e.response.text}")
+    except requests.exceptions.RequestException as e:
+        logging.error(f"API streaming request to {url} failed: {e}", exc_info=True)
+        st.error(f"Failed to send data to the backend API. Please try again.")
+    except ValueError as e:
+        logging.error(f"API streaming request to {url} returned a malformed event: {e}", exc_info=True)
+        st.error("Received an invalid response from the backend API. Please try again.")
+
 def _api_upload_request(uploaded_file: Any, api_key: str, api_endpoint: str, deployment_name: str, model_name: str) -> Optional[Dict[str, Any]]:
     """A helper function for making multipart/form-data API POST requests for file uploads."""
     try:
@@ -107,7 +217,7 @@ def _api_upload_request(uploaded_file: Any, api_key: str, api_endpoint: str, dep
             'deployment_name': deployment_name,
             'model_name': model_name
         }
-        response = requests.post(url, files=files, data=data, timeout=60)
+        response = get_http_session().post(url, files=files, data=data, timeout=60)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.HTTPError as e:
@@ -121,33 +231,116 @@ def _api_upload_request(uploaded_file: Any, api_key: str, api_endpoint: str, dep
         return None
 
 # --- Data Fetching ---
-@st.cache_data(ttl=30)
+# Keyed by the filter pair, so max_entries keeps the number of cached result sets bounded
+@st.cache_data(ttl=CACHE_TTL_INVOICES, max_entries=64, show_spinner=False)
+def fetch_bootstrap(vendor_name: Optional[str] = "All Vendors", risk_level: Optional[str] = "All Risk Levels") -> Optional[Dict[str, Any]]:
+    """
+    Fetches the summary metrics, vendor list, and filtered invoices in a single backend request.
+    The fetch_* helpers below read their slice of this response. The fetch time is recorded
+    alongside it, so cached hits report when the data was actually loaded.
+    """
+    params = {}
+    if vendor_name and vendor_name != "All Vendors":
+        params["vendor_name"] = vendor_name
+    if risk_level and risk_level != "All Risk Levels":
+        params["risk_level"] = risk_level
+    bootstrap = _api_get_request("/api/dashboard/bootstrap", params=params)
+    if not bootstrap:
+        return None
+    # Copied so the body kept for ETag revalidation is left untouched
+    return {**bootstrap, "fetched_at": datetime.now()}
+
+def _current_filters() -> Tuple[str, str]:
+    """Returns the current vendor and risk level filter selections (the widget defaults on first load)."""
+    return (
+        st.session_state.get(WIDGET_KEY_VENDOR_FILTER, "All Vendors"),
+        st.session_state.get(WIDGET_KEY_RISK_FILTER, "All Risk Levels"),
+    )
+
 def fetch_summary_metrics() -> Optional[Dict[str, Any]]:
-    """Fetches summary metrics from the backend API using the centralized helper."""
-    return _api_get_request("/api/dashboard/summary")
+    """Returns the summary metrics from the bootstrap response for the current filters."""
+    bootstrap = fetch_bootstrap(*_current_filters())
+    return bootstrap.get("summary") if bootstrap else None
 
-@st.cache_data(ttl=30)
-def fetch_vendors() -> List[str]:
+def fetch_last_updated() -> Optional[datetime]:
+    """Returns when the data for the current filters was last fetched from the backend."""
+    bootstrap = fetch_bootstrap(*_current_filters())
+    return bootstrap.get("fetched_at") if bootstrap else None
+
+@st.cache_data(persist="disk", max_entries=4, show_spinner=False)
+def _fetch_vendor_list(refresh_window: int) -> List[str]:
     """
-    Fetches the list of unique vendors from a dedicated endpoint to avoid loading all invoices.
+    Returns the list of unique vendors from the unfiltered bootstrap response.
+    `refresh_window` only keys the cache, so the persisted list is refetched once per window.
     """
-    vendors_data = _api_get_request("/api/vendors")
+    # Explicit defaults so this shares the cache entry of the unfiltered first paint
+    bootstrap = fetch_bootstrap("All Vendors", "All Risk Levels")
+    vendors_data = bootstrap.get("vendors") if bootstrap else None
     # FIX: Added a type check to handle potential malformed API responses gracefully.
     if isinstance(vendors_data, list):
         return ["All Vendors"] + sorted(vendors_data)
     return ["All Vendors"]
 
-@st.cache_data(ttl=30)
-def fetch_invoices(vendor_name: Optional[str] = None, risk_level: Optional[str] = None) -> Optional[List[Dict[str, Any]]]:
+def fetch_vendors() -> List[str]:
+    """Returns the vendor list, served from the disk cache across app restarts."""
+    return _fetch_vendor_list(int(time.time() // CACHE_TTL_VENDORS_SECONDS))
+
+def fetch_invoices(vendor_name: Optional[str] = "All Vendors", risk_level: Optional[str] = "All Risk Levels") -> Optional[List[Dict[str, Any]]]:
     """
-    Fetches invoices from the backend, optionally filtering by vendor.
+    Returns the invoices from the bootstrap response, optionally filtering by vendor.
     """
-    params = {}
-    if vendor_name and vendor_name != "All Vendors":
-        params["vendor_name"] = vendor_name
-    if risk_level and risk_level != "All Risk Levels":
-        params["risk_level"] = risk_level
-    return _api_get_request("/api/invoices/", params=params)
+    bootstrap = fetch_bootstrap(vendor_name, risk_level)
+    return bootstrap.get("invoices") if bootstrap else None
+
+@st.cache_data(ttl=CACHE_TTL_INVOICES, max_entries=64, show_spinner=False)
+def _build_invoice_df(vendor_name: Optional[str], risk_level: Optional[str]) -> Optional[pd.DataFrame]:
+    """
+    Builds the invoice table DataFrame for a filter combination, with its display columns.
+    Cached so reruns that don't change the filters skip the DataFrame construction entirely.
+    Returns None if the backend returned no invoice data.
+    """
+    invoices_data = fetch_invoices(vendor_name=vendor_name, risk_level=risk_level)
+    if not invoices_data:
+        return None
+
+    df = pd.DataFrame.from_records(invoices_data, columns=list(_INVOICE_DTYPES)).astype(_INVOICE_DTYPES, copy=False)
+
+    # Vectorized column construction; unknown or missing levels fall back to "Low" as before.
+    # Mapped as object dtype, since filling a categorical with a label outside its categories raises.
+    df['risk_level_display'] = df['risk_level'].astype(object).map(_RISK_DISPLAY).fillna(_RISK_DISPLAY["Low"])
+    df["pdf_url"] = BACKEND_API_URL + "/api/invoices/" + df["invoice_id"].astype(str) + "/pdf"
+    df["Summarise"] = False
+    # Index by invoice ID so the detail panels look rows up by label instead of scanning the column
+    return df.set_index("invoice_id", drop=False)
+
+@st.cache_data(ttl=CACHE_TTL_INVOICES, max_entries=64, show_spinner=False)
+def _compute_top_vendors(vendor_name: Optional[str], risk_level: Optional[str]) -> Optional[pd.Series]:
+    """
+    Returns the five vendors with the highest average risk score for a filter combination.
+    Keyed on the filters rather than the DataFrame, so Streamlit never hashes the table itself.
+    """
+    df = _build_invoice_df(vendor_name, risk_level)
+    if df is None or df.empty:
+        return None
+    return df.groupby('vendor_name', observed=True)['risk_score'].mean().nlargest(5)
+
+@contextmanager
+def _narrative_in_flight(invoice_id: str) -> Iterator[bool]:
+    """
+    Marks a narrative request for an invoice as in flight while the block runs. Yields False,
+    without marking, if one is already running (e.g. after a double-click) so it can be skipped.
+    """
+    inflight = st.session_state.setdefault(SESSION_STATE_NARRATIVE_INFLIGHT, {})
+    if invoice_id in inflight:
+        logging.info(f"Narrative request for invoice {invoice_id} already in flight; skipping duplicate.")
+        yield False
+        return
+
+    inflight[invoice_id] = True
+    try:
+        yield True
+    finally:
+        inflight.pop(invoice_id, None)
 
 def fetch_ai_narrative(invoice_id: str, api_key: str, api_endpoint: str, deployment_name: str, model_name: str) -> Optional[Dict[str, Any]]:
     """
@@ -159,18 +352,74 @@ def fetch_ai_narrative(invoice_id: str, api_key: str, api_endpoint: str, deploym
         st.error("API Key is required to generate a summary. Please enter it in the sidebar.")
         return None
 
-    # Pass the API key in the JSON body of the POST request
-    return _api_post_request(
-        f"/api/invoices/{invoice_id}/narrative",
+    with _narrative_in_flight(invoice_id) as claimed:
+        if not claimed:
+            return None
+        # Pass the API key in the JSON body of the POST request
+        return _api_post_request(
+            f"/api/invoices/{invoice_id}/narrative",
+            json_data={
+                "api_key": api_key,
+                "api_endpoint": api_endpoint,
+                "deployment_name": deployment_name,
+                "model_name": model_name
+            }
+        )
+
+def stream_ai_narrative(invoice_id: str, api_key: str, api_endpoint: str, deployment_name: str, model_name: str, result: Dict[str, str]) -> Iterator[str]:
+    """
+    Streams the GenAI narrative for an invoice, yielding text chunks as the model produces them
+    (for st.write_stream). The cleaned final narrative is stored in result["narrative"].
+    """
+    with _narrative_in_flight(invoice_id) as claimed:
+        if not claimed:
+            return
+        events = _api_post_stream(
+            f"/api/invoices/{invoice_id}/narrative/stream",
+            json_data={
+                "api_key": api_key,
+                "api_endpoint": api_endpoint,
+                "deployment_name": deployment_name,
+                "model_name": model_name
+            }
+        )
+        for event, text in events:
+            if event == "done":
+                result["narrative"] = text
+            else:
+                yield text
+
+def fetch_ai_narratives_batch(invoice_ids: List[str], api_key: str, api_endpoint: str, deployment_name: str, model_name: str) -> Optional[Dict[Any, str]]:
+    """
+    Fetches GenAI narratives for several invoices in one backend request, whose LLM calls run
+    concurrently. Returns a mapping of invoice ID to narrative.
+    """
+    if not invoice_ids:
+        return None
+    if not api_key:
+        st.error("API Key is required to generate a summary. Please enter it in the sidebar.")
+        return None
+
+    narratives = _api_post_request(
+        "/api/invoices/narratives/batch",
         json_data={
+            "invoice_ids": [int(invoice_id) for invoice_id in invoice_ids],
             "api_key": api_key,
             "api_endpoint": api_endpoint,
             "deployment_name": deployment_name,
             "model_name": model_name
         }
     )
+    if not isinstance(narratives, list):
+        return None
+    return {item["invoice_id"]: item["narrative"] for item in narratives}
 
 # --- UI Components ---
+def display_last_updated():
+    """Shows when the dashboard data was last fetched, rather than the time of the current rerun."""
+    fetched_at = fetch_last_updated()
+    st.info(f"Last Updated: {fetched_at:%Y-%m-%d %H:%M:%S}" if fetched_at else "Last Updated: N/A")
+
 def display_summary_metrics():
     """Fetches and displays the summary metric cards."""
     summary_data = fetch_summary_metrics()
@@ -200,36 +449,26 @@ def display_summary_metrics():
         with col3:
             st.metric(label="Average Risk Score", value="-")
 
-def display_visualizations(df: pd.DataFrame):
+def display_visualizations(vendor_name: Optional[str], risk_level: Optional[str]):
     """Displays a single, polished chart for the top 5 high-risk vendors."""
     st.subheader("Data Visualizations")
 
-    if df is None or df.empty:
+    top_vendors = _compute_top_vendors(vendor_name, risk_level)
+    if top_vendors is None or top_vendors.empty:
         st.info("No data available to display visualizations.")
         return
 
     st.markdown("<h6>Top 5 High-Risk Vendors</h6>", unsafe_allow_html=True)
-    top_vendors = df.groupby('vendor_name')['risk_score'].mean().nlargest(5)
-    
-    plt.style.use('dark_background')
-    fig, ax = plt.subplots(figsize=(10, 6))
-    bars = ax.bar(top_vendors.index, top_vendors.values, color='deepskyblue', edgecolor='black')
-    
-    ax.set_title('Top 5 Vendors by Average Risk Score', fontsize=16, color='white')
-    ax.set_xlabel('Vendor', fontsize=12, color='white')
-    ax.set_ylabel('Average Risk Score', fontsize=12, color='white')
-    
-    ax.tick_params(colors='white', which='both')
-    plt.xticks(rotation=45, ha="right")
-    
-    for bar in bars:
-        yval = bar.get_height()
-        ax.text(bar.get_x() + bar.get_width()/2.0, yval + 0.01, f'{yval:.2f}', ha='center', va='bottom', color='white')
 
-    fig.patch.set_facecolor('none')
-    ax.set_facecolor('none')
-
-    st.pyplot(fig, use_container_width=True)
+    # Native Vega-Lite chart: rendered in the browser, no matplotlib figure or PNG per rerun.
+    # sort=False keeps the nlargest order (highest risk first).
+    st.bar_chart(
+        top_vendors,
+        x_label="Vendor",
+        y_label="Average Risk Score",
+        color="#00BFFF",
+        sort=False
+    )
 
 def display_invoice_table() -> Optional[pd.DataFrame]:
     """Displays the vendor filter and the interactive invoice table."""
@@ -248,29 +487,15 @@ def display_invoice_table() -> Optional[pd.DataFrame]:
         selected_risk_level = st.selectbox(
             "Filter by Risk Level",
             options=["All Risk Levels", "High", "Medium", "Low"],
-            key="risk_level_filter"
+            key=WIDGET_KEY_RISK_FILTER
         )
 
-    invoices_data = fetch_invoices(vendor_name=selected_vendor, risk_level=selected_risk_level)
-
-    if not invoices_data:
-        st.warning("Could not retrieve invoice data from the backend. The invoice table cannot be displayed.")
-        return None
-
     try:
-        df = pd.DataFrame(invoices_data)
-
-        def get_risk_level_display(level):
-            if level == 'High':
-                return "High 🔴"
-            elif level == 'Medium':
-                return "Medium 🟠"
-            return "Low 🟢"
-
-        df['risk_level_display'] = df['risk_level'].apply(get_risk_level_display)
-        df["pdf_url"] = df["invoice_id"].apply(lambda id: f"{BACKEND_API_URL}/api/invoices/{id}/pdf")
-        df["Summarise"] = False
-        
+        df = _build_invoice_df(selected_vendor, selected_risk_level)
+        if df is None:
+            st.warning("Could not retrieve invoice data from the backend. The invoice table cannot be displayed.")
+            return None
+
         display_columns = [
             "invoice_id", "vendor_name", "invoice_date", "amount", 
             "risk_score", "risk_level_display", "pdf_url", "Summarise"
@@ -283,7 +508,7 @@ def display_invoice_table() -> Optional[pd.DataFrame]:
             column_config={
                 "invoice_id": "Invoice ID",
                 "vendor_name": "Vendor Name",
-                "invoice_date": "Invoice Date",
+                "invoice_date": st.column_config.DateColumn("Invoice Date", format="YYYY-MM-DD"),
                 "amount": st.column_config.NumberColumn("Amount", format="$%.2f"),
                 "risk_score": st.column_config.ProgressColumn(
                     "Risk Score",
@@ -322,18 +547,43 @@ def display_comparative_analysis(invoices_df: pd.DataFrame, selected_ids: List[s
         return
 
     st.subheader("Comparative Analysis")
-    col1, col2 = st.columns(2)
-
-    for i, invoice_id in enumerate(selected_ids):
-        invoice_data = invoices_df[invoices_df['invoice_id'] == invoice_id].iloc[0]
-        with (col1 if i == 0 else col2):
+    # Both rows in one indexed lookup, in selection order
+    rows = invoices_df.loc[selected_ids]
+    for column, (invoice_id, invoice_data) in zip(st.columns(2), rows.iterrows()):
+        with column:
             st.markdown(f"#### Invoice: `{invoice_id}`")
             st.text(f"Vendor: {invoice_data['vendor_name']}")
-            st.text(f"Date: {invoice_data['invoice_date']}")
+            st.text(f"Date: {invoice_data['invoice_date']:%Y-%m-%d}")
             st.metric(label="Amount", value=f"${invoice_data['amount']:.2f}")
             st.metric(label="Risk Score", value=f"{invoice_data['risk_score']:.2f}")
-
-
+            if f"narrative_{invoice_id}" in st.session_state:
+                with st.expander("AI-Generated Summary", expanded=True):
+                    for paragraph in st.session_state[f"narrative_{invoice_id}"].split('\n'):
+                        if paragraph.strip():
+                            st.markdown(f"💡 {paragraph}")
+
+    missing_ids = [invoice_id for invoice_id in selected_ids if f"narrative_{invoice_id}" not in st.session_state]
+    if missing_ids and st.button("Generate Both Summaries", key="generate_comparison_summaries"):
+        api_key = st.session_state.get("api_key")
+        if not api_key:
+            st.error("API Key is required to generate a summary. Please enter it in the sidebar.")
+        else:
+            with st.spinner("Generating AI summaries... This may take a moment."):
+                # One request for both invoices; the backend runs the LLM calls concurrently
+                narratives = fetch_ai_narratives_batch(
+                    missing_ids,
+                    api_key,
+                    st.session_state.get(SESSION_STATE_API_ENDPOINT),
+                    st.session_state.get(SESSION_STATE_DEPLOYMENT_NAME),
+                    st.session_state.get(SESSION_STATE_MODEL_NAME)
+                )
+                if narratives:
+                    for invoice_id in missing_ids:
+                        if invoice_id in narratives:
+                            st.session_state[f"narrative_{invoice_id}"] = narratives[invoice_id]
+                    st.rerun()
+                else:
+                    st.error("Failed to generate summaries. The backend did not return any narratives.")
 
 def display_single_invoice_details(invoices_df: pd.DataFrame, selected_ids: List[str]):
     """Displays the details of a single selected invoice and the AI summary."""
@@ -341,13 +591,13 @@ def display_single_invoice_details(invoices_df: pd.DataFrame, selected_ids: List
         return
 
     invoice_id = selected_ids[0]
-    invoice_data = invoices_df[invoices_df['invoice_id'] == invoice_id].iloc[0]
+    invoice_data = invoices_df.loc[invoice_id]
 
     st.subheader(f"Details for Invoice: `{invoice_id}`")
     col1, col2 = st.columns(2)
     with col1:
         st.text(f"Vendor: {invoice_data['vendor_name']}")
-        st.text(f"Date: {invoice_data['invoice_date']}")
+        st.text(f"Date: {invoice_data['invoice_date']:%Y-%m-%d}")
     with col2:
         st.metric(label="Amount", value=f"${invoice_data['amount']:.2f}")
         st.metric(label="Risk Score", value=f"{invoice_data['risk_score']:.2f}")
@@ -358,10 +608,31 @@ def display_single_invoice_details(invoices_df: pd.DataFrame, selected_ids: List
             for paragraph in narrative.split('\n'):
                 if paragraph.strip():
                     st.markdown(f"💡 {paragraph}")
-    elif st.button("Generate AI Summary", key=f"generate_summary_{invoice_id}"):
+    elif st.button(
+        "Generate AI Summary",
+        key=f"generate_summary_{invoice_id}",
+        disabled=invoice_id in st.session_state.get(SESSION_STATE_NARRATIVE_INFLIGHT, {}),
+    ):
         api_key = st.session_state.get("api_key")
         if not api_key:
             st.error("API Key is required to generate a summary. Please enter it in the sidebar.")
+        elif STREAMING_NARRATIVE:
+            # Show tokens as they arrive, then keep the backend's cleaned text
+            result = {}
+            with st.expander("AI-Generated Summary", expanded=True):
+                st.write_stream(stream_ai_narrative(
+                    invoice_id,
+                    api_key,
+                    st.session_state.get(SESSION_STATE_API_ENDPOINT),
+                    st.session_state.get(SESSION_STATE_DEPLOYMENT_NAME),
+                    st.session_state.get(SESSION_STATE_MODEL_NAME),
+                    result
+                ))
+            if "narrative" in result:
+                st.session_state[f"narrative_{invoice_id}"] = result["narrative"]
+                st.rerun()
+            else:
+                st.error("Failed to generate summary. The backend did not return a narrative.")
         else:
             with st.spinner("Generating AI summary... This may take a moment."):
                 narrative_data = fetch_ai_narrative(
@@ -377,6 +648,29 @@ def display_single_invoice_details(invoices_df: pd.DataFrame, selected_ids: List
                 else:
                     st.error("Failed to generate summary. The backend did not return a narrative.")
 
+def display_invoice_review():
+    """
+    Renders the invoice table, chart, and detail panels. Run as a fragment, so toggling a row or
+    changing a filter reruns only this section instead of the whole dashboard.
+    """
+    invoices_df = display_invoice_table()
+
+    if invoices_df is not None:
+        display_visualizations(
+            st.session_state.get(WIDGET_KEY_VENDOR_FILTER),
+            st.session_state.get(WIDGET_KEY_RISK_FILTER)
+        )
+        st.divider()
+        
+        selected_ids = st.session_state.get(SESSION_STATE_COMPARISON_IDS, [])
+        logging.info(f"Selected invoice IDs from session state: {selected_ids}")
+        if selected_ids:
+            st.subheader("Invoice Details")
+            display_single_invoice_details(invoices_df, selected_ids)
+            display_comparative_analysis(invoices_df, selected_ids)
+        else:
+            st.info("Select one or two invoices from the table to see more details.")
+
 # --- Main Application ---
 def run_app():
     """Initializes and runs the Streamlit dashboard application."""
@@ -428,7 +722,10 @@ def run_app():
     # --- Sidebar ---
     st.sidebar.title("Dashboard Controls")
 
-    st.sidebar.info(f"Last Updated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    # Polls with the auto-refresh cadence, so the timestamp follows the data rather than reruns
+    refresh_every = AUTO_REFRESH_INTERVAL if st.session_state.get(SESSION_STATE_AUTO_REFRESH) else None
+    with st.sidebar:
+        st.fragment(display_last_updated, run_every=refresh_every)()
     st.sidebar.divider()
 
     st.sidebar.title("Process New Invoice")
@@ -478,26 +775,12 @@ def run_app():
                     st.rerun()
 
     # Main dashboard layout
-    display_summary_metrics()
+    # With auto-refresh on, each fragment polls on its own timer instead of rerunning the whole
+    # script; the polls read through the data caches, so new data shows once their TTL expires
+    st.fragment(display_summary_metrics, run_every=refresh_every)()
     st.divider()
 
-    invoices_df = display_invoice_table()
-
-    if invoices_df is not None:
-        display_visualizations(invoices_df)
-        st.divider()
-        
-        selected_ids = st.session_state.get(SESSION_STATE_COMPARISON_IDS, [])
-        logging.info(f"Selected invoice IDs from session state: {selected_ids}")
-        if selected_ids:
-            st.subheader("Invoice Details")
-            display_single_invoice_details(invoices_df, selected_ids)
-            display_comparative_analysis(invoices_df, selected_ids)
-        else:
-            st.info("Select one or two invoices from the table to see more details.")
-
-    if st.session_state.get(SESSION_STATE_AUTO_REFRESH):
-        st_autorefresh(interval=30 * 1000, key="data_refresher")
+    st.fragment(display_invoice_review, run_every=refresh_every)()
 
 # --- Execution Guard ---
 if __name__ == "__main__":